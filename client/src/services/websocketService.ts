@@ -1,28 +1,41 @@
-import { Session } from "@/types/Session";
-import { Playlist } from "@/types/Playlist";
-import { SongList } from "@/types/Song";
+import { Delta, SessionEvent, PlaylistEvent, RecommendationEvent } from "@/types/Delta";
 
 
-class WebsocketService<Type> {
+export interface TopicHandlers {
+    session: (message: SessionEvent) => void;
+    playlist: (message: PlaylistEvent) => void;
+    recommendations: (message: RecommendationEvent) => void;
+}
+
+type Topic = keyof TopicHandlers;
+
+interface TopicFrame {
+    topic: Topic;
+    event: Delta;
+}
+
+// One connection per client for all topics of a session, every frame is tagged with its topic.
+export class SessionWebsocketService {
     socket: WebSocket | null
     reconnectTimeout: number;
     maxReconnectAttempts: number;
     reconnectAttempts: number;
-    typeAddress: string;
+    lastSeq: Record<Topic, number>;
 
-    constructor(typeAddress: string) {
+    constructor() {
         this.reconnectTimeout = 2000;
         this.maxReconnectAttempts = 10;
         this.reconnectAttempts = 0;
         this.socket = null;
-        this.typeAddress = typeAddress;
+        this.lastSeq = { session: 0, playlist: 0, recommendations: 0 };
     }
 
     connect(
         sessionId: string,
-        handler: ((message: Type) => void)
+        handlers: TopicHandlers
     ) {
-        this.socket = new WebSocket(`${import.meta.env.VITE_WS_BASE_URL}/${this.typeAddress}/${sessionId}`)
+        const topics = Object.keys(handlers).join(',');
+        this.socket = new WebSocket(`${import.meta.env.VITE_WS_BASE_URL}/ws/${sessionId}?topics=${topics}`)
 
         this.socket.onopen = () => {
             console.log('Websocket connection established!')
@@ -31,13 +44,24 @@ class WebsocketService<Type> {
 
         this.socket.onmessage = (event) => {
             console.log('Message received:' + event.data);
-            handler(JSON.parse(event.data));
+            const { topic, event: message }: TopicFrame = JSON.parse(event.data);
+            const handler = handlers[topic] as (message: Delta) => void;
+            if (message.type === 'snapshot') {
+                this.lastSeq[topic] = message.seq;
+                handler(message);
+            } else if (message.seq === this.lastSeq[topic] + 1) {
+                this.lastSeq[topic] = message.seq;
+                handler(message);
+            } else if (message.seq > this.lastSeq[topic] + 1) {
+                // Missed at least one event, the server answers with a snapshot of the current state
+                this.sendMessage(JSON.stringify({ type: 'snapshot', topic }));
+            } // Events with seq <= lastSeq are already contained in the state
         }
 
         this.socket.onclose = (event) => {
             console.log('Websocket disconnected!')
             if (event.code !== 1001) { // Do not attempt to reconnect if the connection was closed normally from serverside (code 1001)
-                this.attemptReconnect(sessionId, handler);
+                this.attemptReconnect(sessionId, handlers);
             }
         }
 
@@ -49,13 +73,13 @@ class WebsocketService<Type> {
 
     attemptReconnect(
         sessionId: string,
-        handler: ((message: Type) => void)
+        handlers: TopicHandlers
     ) {
         if (this.reconnectAttempts < this.maxReconnectAttempts) {
             setTimeout(() => {
                 console.log('Attempting to reconnect to WebSocket...');
                 this.reconnectAttempts++;
-                this.connect(sessionId, handler);
+                this.connect(sessionId, handlers);
             }, this.reconnectTimeout);
             this.reconnectTimeout *= 2; // Exponential backoff
         } else {
@@ -75,21 +99,3 @@ class WebsocketService<Type> {
         this.socket?.close(1000, 'Client closed connection.'); // Close with normal closure code 1000
     }
 }
-
-export class SessionWebsocketService extends WebsocketService<Session> {
-    constructor() {
-        super("sessions");
-    }
-}
-
-export class PlaylistWebsocketService extends WebsocketService<Playlist> {
-    constructor() {
-        super("playlist");
-    }
-}
-
-export class RecommendationWebsocketService extends WebsocketService<SongList> {
-    constructor() {
-        super("recommendations");
-    }
-}
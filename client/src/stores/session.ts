@@ -5,19 +5,31 @@ import {Session} from '@/types/Session'
 import {Playlist} from '@/types/Playlist'
 import { SongList } from '@/types/Song'
 import { Artifacts } from '@/types/Artifact'
-import { SessionWebsocketService, PlaylistWebsocketService, RecommendationWebsocketService } from "@/services/websocketService";
+import { SessionEvent, PlaylistEvent, RecommendationEvent } from '@/types/Delta'
+import { SessionWebsocketService } from "@/services/websocketService";
 
 export const useSession = defineStore('session', () => {
 
     const session = ref<Session | null>(null);
 
     const sessionSocket = new SessionWebsocketService();
-    const playlistSocket = new PlaylistWebsocketService();
-    const recommendationsSocket = new RecommendationWebsocketService();
 
     const storedSessionId = localStorage.getItem('sessionId')
 
-    const handleSessionMessages = (sessionMessage: Session) => {
+    const handleSessionMessages = (sessionEvent: SessionEvent) => {
+        switch (sessionEvent.type) {
+            case 'snapshot':
+                return applySession(sessionEvent.data);
+            case 'guest_joined':
+                session.value.guests[sessionEvent.guest.id] = sessionEvent.guest;
+                return;
+            case 'guest_left':
+                delete session.value.guests[sessionEvent.guestId];
+                return;
+        }
+    };
+
+    const applySession = (sessionMessage: Session) => {
         const playlist = sessionMessage.playlist || session.value.playlist;
         const recommendations = sessionMessage.recommendations || session.value.recommendations;
         const votingStartTime = sessionMessage.recommendations || session.value.votingStartTime;
@@ -30,12 +42,52 @@ export const useSession = defineStore('session', () => {
         };
     };
       
-    const handlePlaylistMessages = (playlistMessage: Playlist) => {
+    const handlePlaylistMessages = (playlistEvent: PlaylistEvent) => {
+        if (playlistEvent.type === 'snapshot') {
+            session.value.playlist = playlistEvent.data;
+            return;
+        }
         session.value.recommendations = [];
-        session.value.playlist = playlistMessage;
+        const playlist: Playlist = session.value.playlist;
+        switch (playlistEvent.type) {
+            case 'song_queued':
+                playlist.queuedSongs.push(playlistEvent.song);
+                break;
+            case 'song_removed':
+                playlist.queuedSongs = playlist.queuedSongs.filter((song) => song.id !== playlistEvent.songId);
+                break;
+            case 'playlist_advanced':
+                if (playlist.currentSong) {
+                    playlist.playedSongs.push(playlist.currentSong);
+                }
+                if (playlist.queuedSongs[0]?.id === playlistEvent.currentSong.id) {
+                    playlist.queuedSongs.shift();
+                }
+                playlist.currentSong = playlistEvent.currentSong;
+                break;
+        }
     };
-      
-    const handleRecommendationMessages = (recommendationMessage: SongList) => {
+
+    const handleRecommendationMessages = (recommendationEvent: RecommendationEvent) => {
+        switch (recommendationEvent.type) {
+            case 'snapshot':
+                return applyRecommendations(recommendationEvent.data);
+            case 'recommendations_replaced':
+                return applyRecommendations(recommendationEvent);
+            case 'votes_changed':
+                for (const change of recommendationEvent.changes) {
+                    for (const recommendation of session.value.recommendations) {
+                        recommendation.votes = recommendation.votes.filter((guestId) => guestId !== change.guestId);
+                        if (recommendation.id === change.songId) {
+                            recommendation.votes.push(change.guestId);
+                        }
+                    }
+                }
+                return;
+        }
+    };
+
+    const applyRecommendations = (recommendationMessage: SongList) => {
        session.value.recommendations = recommendationMessage.songs;
        if (recommendationMessage.votingStartTime) {
          session.value.votingStartTime = recommendationMessage.votingStartTime;
@@ -44,7 +96,7 @@ export const useSession = defineStore('session', () => {
 
     const fetchRecommendations = async () => {
         console.log("Fetching recommendations");
-        handleRecommendationMessages(await sessionService.getRecommendations(session.value.id));
+        applyRecommendations(await sessionService.getRecommendations(session.value.id));
     }
 
     const initialize = async () => {
@@ -53,9 +105,11 @@ export const useSession = defineStore('session', () => {
 
         localStorage.setItem('sessionId', session.value.id);
 
-        sessionSocket.connect(session.value.id, handleSessionMessages);
-        playlistSocket.connect(session.value.id, handlePlaylistMessages);
-        recommendationsSocket.connect(session.value.id, handleRecommendationMessages);
+        sessionSocket.connect(session.value.id, {
+            session: handleSessionMessages,
+            playlist: handlePlaylistMessages,
+            recommendations: handleRecommendationMessages,
+        });
     }
 
     const fetchSession = async (sessionId: string | null) => {
@@ -91,8 +145,6 @@ export const useSession = defineStore('session', () => {
             session.value.guests = {};
 
             sessionSocket.close();
-            playlistSocket.close();
-            recommendationsSocket.close();
         } catch (error) {
             console.error ("Failed to end session or fetch artifacts", error);
         }
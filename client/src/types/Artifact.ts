@@ -14,6 +14,22 @@ export class AverageFeatures {
     }
 }
 
+export class FeatureTrajectory {
+    danceability: number[];
+    energy: number[];
+    speechiness: number[];
+    valence: number[];
+    scaledTempo: number[];
+
+    constructor(data: FeatureTrajectory) {
+        this.danceability = data.danceability;
+        this.energy = data.energy;
+        this.speechiness = data.speechiness;
+        this.valence = data.valence;
+        this.scaledTempo = data.scaledTempo;
+    }
+}
+
 export class Artifacts {
     songsPlayed: number;
     songsAddedManually: number;
@@ -22,6 +38,7 @@ export class Artifacts {
     mostSignificantFeatureOverall: string;
     firstRecommendationVotePercentage: number;
     averageFeatures: AverageFeatures;
+    featureTrajectory?: FeatureTrajectory;
     genreStart: string[];
     genreEnd: string[];
 
@@ -33,6 +50,7 @@ export class Artifacts {
         this.mostSignificantFeatureOverall = data.mostSignificantFeatureOverall;
         this.firstRecommendationVotePercentage = data.firstRecommendationVotePercentage;
         this.averageFeatures = new AverageFeatures(data.averageFeatures);
+        this.featureTrajectory = data.featureTrajectory ? new FeatureTrajectory(data.featureTrajectory) : undefined;
         this.genreStart = data.genreStart;
         this.genreEnd = data.genreEnd;
     }
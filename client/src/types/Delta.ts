@@ -0,0 +1,60 @@
+import { User } from '@/types/User';
+import { Song, SongList } from '@/types/Song';
+import { Playlist } from '@/types/Playlist';
+import { Session } from '@/types/Session';
+
+// Websocket events only describe what changed. seq increases by one per event of a topic within a session.
+export interface Delta {
+    seq: number;
+    type: string;
+}
+
+export interface Snapshot<Type> extends Delta {
+    type: 'snapshot';
+    data: Type;
+}
+
+export interface GuestJoined extends Delta {
+    type: 'guest_joined';
+    guest: User;
+}
+
+export interface GuestLeft extends Delta {
+    type: 'guest_left';
+    guestId: string;
+}
+
+export interface SongQueued extends Delta {
+    type: 'song_queued';
+    song: Song;
+}
+
+export interface SongRemoved extends Delta {
+    type: 'song_removed';
+    songId: string;
+}
+
+export interface PlaylistAdvanced extends Delta {
+    type: 'playlist_advanced';
+    currentSong: Song;
+}
+
+export interface RecommendationsReplaced extends Delta {
+    type: 'recommendations_replaced';
+    songs: Song[];
+    votingStartTime: Date;
+}
+
+export interface VoteChange {
+    guestId: string;
+    songId: string | null; // null if the guest withdrew the vote
+}
+
+export interface VotesChanged extends Delta {
+    type: 'votes_changed';
+    changes: VoteChange[];
+}
+
+export type SessionEvent = Snapshot<Session> | GuestJoined | GuestLeft;
+export type PlaylistEvent = Snapshot<Playlist> | SongQueued | SongRemoved | PlaylistAdvanced;
+export type RecommendationEvent = Snapshot<SongList> | RecommendationsReplaced | VotesChanged;
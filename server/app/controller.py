@@ -3,19 +3,25 @@ import time
 
 from contextlib import asynccontextmanager
 from databases import Database
-from fastapi import FastAPI, status, Depends, WebSocket
+from fastapi import FastAPI, HTTPException, status, Depends, Query, WebSocket, Request, Response
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
 from redis.asyncio import Redis
 from starlette.middleware.cors import CORSMiddleware
-from typing import Annotated
+from typing import Annotated, Optional
+
+import metrics
 
 from models.artifact import Artifact
-from models.token import Token
+from models.token import Token, SpotifyRefresh
 from models.user import User, SpotifyUser
 from models.session import Session
 from models.song import Song, SongList, Playlist
+from migrations import MigrationRunner
+from recommendation_engine import NumpyRecommendationEngine
 from repository import Repository
 from service import Service
-from websocket_service import WebSocketService
+from session_sweeper import SessionSweeper
+from websocket_service import WebSocketService, TOPICS
 from ws.websocket_manager import WebsocketManager
 
 POSTGRES_USER = os.getenv("POSTGRES_USER")
@@ -26,21 +32,42 @@ POSTGRES_DB = os.getenv("POSTGRES_DB")
 REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_PORT = int(os.getenv("REDIS_PORT"))
 REDIS_SSL = os.getenv("REDIS_SSL", "false") == "true"
+RECOMMENDATION_ENGINE = os.getenv("RECOMMENDATION_ENGINE") or "sql"
 
 manager = WebsocketManager()
 postgres = Database(f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}")
 redis = Redis(host=REDIS_HOST, port=REDIS_PORT, ssl=REDIS_SSL, decode_responses=True)
-repository = Repository(postgres, redis)
+recommendation_engine = NumpyRecommendationEngine() if RECOMMENDATION_ENGINE == "numpy" else None
+metrics.instrument_methods(Repository, metrics.REPOSITORY_LATENCY)
+repository = Repository(postgres, redis, recommendation_engine)
+REGISTRY.register(metrics.SongCacheCollector(repository.song_cache))
 service = Service(repository, manager)
-ws_service = WebSocketService(repository, manager)
+ws_service = WebSocketService(repository, manager, service.get_snapshot, service.get_topic_state)
+
+
+async def release_session(session_id: str) -> None:
+    service.release_session(session_id)
+    await ws_service.disconnect(session_id)
+
+
+sweeper = SessionSweeper(repository, release_session, service.get_local_session_ids, ws_service.get_session_ids)
 
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
     await manager.connect()
     await postgres.connect()
-    await repository.setup_full_text_search()
+    await MigrationRunner(postgres).run()
+    if not await repository.refresh_catalog_statistics_if_stale():
+        await repository.load_catalog_statistics()
+        await repository.load_recommendation_engine()
+    await service.resume_automation()
+    service.scheduler.start()
+    sweeper.start()
     yield
+    await sweeper.stop()
+    await service.scheduler.stop()
+    await service.spotify.close()
     await manager.disconnect()
     await postgres.disconnect()
 
@@ -56,19 +83,73 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def observe_request_latency(request: Request, call_next) -> Response:
+    start = time.perf_counter()
+    status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        # labelled with the route template, not the path, so session and song ids do not create new series
+        route = request.scope.get("route")
+        metrics.ROUTE_LATENCY.labels(request.method, route.path if route else "unmatched", status_code).observe(
+            time.perf_counter() - start)
+
+
+@app.get("/metrics")
+async def get_metrics() -> Response:
+    redis_statistics = await repository.get_memory_statistics()
+    metrics.SESSIONS.set(redis_statistics["sessions"])
+    metrics.REDIS_USED_MEMORY.set(redis_statistics["used_memory"] or 0)
+    metrics.WEBSOCKET_SUBSCRIBERS.set(manager.get_statistics()["subscribers"])
+    websocket_statistics = ws_service.get_statistics()
+    metrics.WEBSOCKET_CONNECTIONS.set(websocket_statistics["connections"])
+    metrics.WEBSOCKET_SESSIONS.set(websocket_statistics["sessions"])
+    service_statistics = service.get_statistics()
+    metrics.ASYNCIO_TASKS.set(service_statistics["tasks"])
+    metrics.SESSION_LOCKS.set(service_statistics["session_locks"])
+    sizes = await repository.get_excluded_recommendations_sizes(
+        service.get_local_session_ids() | ws_service.get_session_ids())
+    metrics.EXCLUDED_RECOMMENDATIONS_BYTES.labels("sum").set(sum(sizes))
+    metrics.EXCLUDED_RECOMMENDATIONS_BYTES.labels("max").set(max(sizes, default=0))
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
+    return {
+        "status": "healthy",
+        "websockets": manager.get_statistics(),
+        "memory": {
+            "redis": await repository.get_memory_statistics(),
+            "process": {
+                **service.get_statistics(),
+                "websocket_sessions": ws_service.get_statistics(),
+                "song_cache": repository.song_cache.get_statistics(),
+                "deleted_idle_sessions": sweeper.deleted_sessions,
+                "released_sessions": sweeper.released_sessions
+            }
+        }
+    }
 
 
 @app.post("/auth-codes", status_code=status.HTTP_201_CREATED, response_model=Token)
 async def authorize_spotify(host: SpotifyUser) -> Token:
-    spotify_token = service.get_spotify_token(host)
-    host.username = service.get_display_name(spotify_token)
+    spotify_token = await service.get_spotify_token(host)
+    host.username = await service.get_display_name(spotify_token)
     host = await service.create_user(host)
     return service.generate_token(host, spotify_token)
 
 
+@app.post("/auth-codes/refresh", status_code=status.HTTP_201_CREATED, response_model=Token)
+async def refresh_spotify_authorization(host_id: Annotated[str, Depends(service.verify_token)], refresh: SpotifyRefresh) -> Token:
+    spotify_token = await service.refresh_spotify_token(refresh.refresh_token)
+    host = await service.get_host(host_id, spotify_token)
+    return service.generate_token(host, spotify_token)
+
+
 @app.post("/token", status_code=status.HTTP_201_CREATED, response_model=Token)
 async def authorize(guest: User) -> Token:
     guest = await service.create_user(guest)
@@ -77,25 +158,25 @@ async def authorize(guest: User) -> Token:
 
 @app.get("/", status_code=status.HTTP_200_OK, response_model=User)
 async def read_root(user_id: Annotated[str, Depends(service.verify_token)]) -> User:
-    await service.verify_instances(user_ids=user_id)
-    return await service.get_user(user_id)
+    users, _ = await service.load_instances(user_ids=user_id)
+    return users[user_id]
 
 
 @app.post("/sessions", status_code=status.HTTP_201_CREATED, response_model=Session)
 async def create_new_session(host_id: Annotated[str, Depends(service.verify_token)], session: Session) -> Session:
-    await service.verify_instances(user_ids=host_id)
-    return await service.create_session(host_id, session)
+    users, _ = await service.load_instances(user_ids=host_id)
+    return await service.create_session(users[host_id], session)
 
 
 @app.get("/sessions/{session_id}", status_code=status.HTTP_200_OK, response_model=Session)
 async def get_specific_session(session_id: str) -> Session:
-    await service.verify_instances(session_id=session_id)
-    return await service.get_session(session_id)
+    _, session = await service.load_instances(session_id=session_id, full_session=True)
+    return session
 
 
 @app.delete("/sessions/{session_id}", status_code=status.HTTP_200_OK, response_model=Artifact)
 async def end_existing_session(host_id: Annotated[str, Depends(service.verify_token)], session_id: str) -> Artifact:
-    await service.verify_instances(user_ids=host_id, session_id=session_id)
+    await service.load_instances(user_ids=host_id, session_id=session_id)
     await ws_service.disconnect(session_id)
     return await service.end_session(host_id, session_id)
 
@@ -110,38 +191,38 @@ async def end_existing_session(host_id: Annotated[str, Depends(service.verify_to
 
 @app.patch("/sessions/{session_id}/guests", status_code=status.HTTP_200_OK, response_model=Session)
 async def add_guest(guest_id: Annotated[str, Depends(service.verify_token)], session_id: str) -> Session:
-    await service.verify_instances(user_ids=guest_id, session_id=session_id)
-    return await service.add_guest_to_session(guest_id, session_id)
+    users, _ = await service.load_instances(user_ids=guest_id, session_id=session_id)
+    return await service.add_guest_to_session(users[guest_id], session_id)
 
 
 @app.delete("/sessions/{session_id}/guests/{guest_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def remove_guest(host_id: Annotated[str, Depends(service.verify_token)], session_id: str, guest_id: str) -> None:
-    await service.verify_instances(user_ids=[host_id, guest_id], session_id=session_id)
+    await service.load_instances(user_ids=[host_id, guest_id], session_id=session_id)
     await service.remove_guest_from_session(host_id, guest_id, session_id)
 
 
 @app.delete("/sessions/{session_id}/guests", status_code=status.HTTP_204_NO_CONTENT)
 async def leave_session(guest_id: Annotated[str, Depends(service.verify_token)], session_id: str) -> None:
-    await service.verify_instances(user_ids=guest_id, session_id=session_id)
+    await service.load_instances(user_ids=guest_id, session_id=session_id)
     await service.remove_guest_from_session("", guest_id, session_id)
 
 
 @app.patch("/sessions/{session_id}/songs", status_code=status.HTTP_200_OK, response_model=Playlist)
 async def add_song(user_id: Annotated[str, Depends(service.verify_token)], session_id: str, song_id: str) -> Playlist:
-    await service.verify_instances(user_ids=user_id, session_id=session_id)
-    return await service.add_song_to_session(user_id, session_id, song_id)
+    users, _ = await service.load_instances(user_ids=user_id, session_id=session_id)
+    return await service.add_song_to_session(users[user_id], session_id, song_id)
 
 
 @app.delete("/sessions/{session_id}/songs/{song_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def remove_song(host_id: Annotated[str, Depends(service.verify_token)], session_id: str, song_id: str) -> None:
-    await service.verify_instances(user_ids=host_id, session_id=session_id)
+    await service.load_instances(user_ids=host_id, session_id=session_id)
     await service.remove_song_from_session(host_id, session_id, song_id)
 
 
 @app.get("/sessions/{session_id}/recommendations", status_code=status.HTTP_200_OK, response_model=SongList)
 async def get_recommendations(user_id: Annotated[str, Depends(service.verify_token)],
                               session_id: str) -> SongList:
-    await service.verify_instances(user_ids=user_id, session_id=session_id)
+    await service.load_instances(user_ids=user_id, session_id=session_id)
     return await service.get_session_recommendations(session_id)
 
 
@@ -149,21 +230,21 @@ async def get_recommendations(user_id: Annotated[str, Depends(service.verify_tok
            response_model=SongList)
 async def add_or_change_vote(guest_id: Annotated[str, Depends(service.verify_token)], session_id: str,
                              song_id: str) -> SongList:
-    await service.verify_instances(user_ids=guest_id, session_id=session_id)
+    await service.load_instances(user_ids=guest_id, session_id=session_id)
     return await service.add_or_change_vote_to_recommendation(guest_id, session_id, song_id)
 
 
 @app.delete("/sessions/{session_id}/recommendations/{song_id}/vote", status_code=status.HTTP_204_NO_CONTENT)
 async def remove_vote(guest_id: Annotated[str, Depends(service.verify_token)], session_id: str, song_id: str) -> None:
-    await service.verify_instances(user_ids=guest_id, session_id=session_id)
+    await service.load_instances(user_ids=guest_id, session_id=session_id)
     await service.remove_vote_from_recommendation(guest_id, session_id, song_id)
 
 
 @app.get("/songs", status_code=status.HTTP_200_OK, response_model=SongList)
 async def get_matching_songs(user_id: Annotated[str, Depends(service.verify_token)], pattern: str,
-                             limit: int = 10) -> SongList:
-    await service.verify_instances(user_ids=user_id)
-    return await service.get_matching_songs_from_database(pattern, limit)
+                             limit: int = Query(10, ge=1, le=100), cursor: Optional[str] = None) -> SongList:
+    await service.load_instances(user_ids=user_id)
+    return await service.get_matching_songs_from_database(pattern, limit, cursor)
 
 
 # @app.post("/songs/{song_id}", status_code=status.HTTP_200_OK, response_model=Song)
@@ -181,31 +262,38 @@ async def get_specific_song(song_id: str) -> Song:
 #     await service.delete_song_from_database(song_id)
 
 
-@app.websocket("/sessions/{session_id}")
-async def websocket_session(websocket: WebSocket, session_id: str):
+async def connect_websocket(websocket: WebSocket, session_id: str, topics: str, tagged: bool) -> None:
+    try:
+        requested_topics = ws_service.parse_topics(topics)
+    except HTTPException:
+        await websocket.close(1008, "Unknown topic.")
+        return
     try:
-        await service.verify_instances(session_id=session_id)
+        await service.load_instances(session_id=session_id)
         await websocket.accept()
     except:
         await websocket.close(1001, "Session does not exist.")
-    await ws_service.connect(websocket, session_id, ws_type="session")
+        return
+    await ws_service.connect(websocket, session_id, requested_topics, tagged)
+
+
+@app.websocket("/ws/{session_id}")
+async def websocket_multiplexed(websocket: WebSocket, session_id: str, topics: str = ",".join(TOPICS)):
+    await connect_websocket(websocket, session_id, topics, tagged=True)
+
+
+# Former single topic endpoints, kept for clients that do not use /ws yet. Instead of the events, they send the full
+# state of their topic (SessionCore, Playlist or SongList) on every change, read once per change on every replica.
+@app.websocket("/sessions/{session_id}")
+async def websocket_session(websocket: WebSocket, session_id: str):
+    await connect_websocket(websocket, session_id, "session", tagged=False)
 
 
 @app.websocket("/playlist/{session_id}")
 async def websocket_playlist(websocket: WebSocket, session_id: str):
-    try:
-        await service.verify_instances(session_id=session_id)
-        await websocket.accept()
-    except:
-        await websocket.close(1001, "Session does not exist.")
-    await ws_service.connect(websocket, session_id, ws_type="playlist")
+    await connect_websocket(websocket, session_id, "playlist", tagged=False)
 
 
 @app.websocket("/recommendations/{session_id}")
 async def websocket_recommendations(websocket: WebSocket, session_id: str):
-    try:
-        await service.verify_instances(session_id=session_id)
-        await websocket.accept()
-    except:
-        await websocket.close(1001, "Session does not exist.")
-    await ws_service.connect(websocket, session_id, ws_type="recommendations")
+    await connect_websocket(websocket, session_id, "recommendations", tagged=False)
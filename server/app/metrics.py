@@ -0,0 +1,81 @@
+import functools
+import inspect
+import time
+
+from prometheus_client import Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from song_cache import SongCache
+
+# from a cached Redis read to a recommendation query over a large catalog
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+ROUTE_LATENCY = Histogram(
+    "http_request_duration_seconds", "Latency of HTTP requests by route template",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS
+)
+REPOSITORY_LATENCY = Histogram(
+    "repository_call_duration_seconds", "Latency of Repository calls, Redis and Postgres included",
+    ["method"], buckets=LATENCY_BUCKETS
+)
+SESSION_LOCK_WAIT = Histogram(
+    "session_lock_wait_seconds", "Time until the session lock, and the lease if configured, was acquired",
+    buckets=LATENCY_BUCKETS
+)
+SESSION_LOCK_HOLD = Histogram(
+    "session_lock_hold_seconds", "Time the session lock was held", buckets=LATENCY_BUCKETS
+)
+FANOUT_LAG = Histogram(
+    "websocket_fanout_lag_seconds", "Time from the Redis publish of an event until it was sent to a websocket",
+    ["topic"], buckets=LATENCY_BUCKETS
+)
+
+SESSIONS = Gauge("sessions", "Sessions in the activity index of Redis")
+REDIS_USED_MEMORY = Gauge("redis_used_memory_bytes", "Memory used by Redis")
+WEBSOCKET_SUBSCRIBERS = Gauge("websocket_subscribers", "Subscribers of the websocket manager on this replica")
+WEBSOCKET_CONNECTIONS = Gauge("websocket_connections", "Open websocket connections on this replica")
+WEBSOCKET_SESSIONS = Gauge("websocket_sessions", "Sessions with open websocket connections on this replica")
+ASYNCIO_TASKS = Gauge("asyncio_tasks", "Background tasks of the sessions on this replica")
+SESSION_LOCKS = Gauge("session_locks", "Session locks held or waited for on this replica")
+EXCLUDED_RECOMMENDATIONS_BYTES = Gauge(
+    "excluded_recommendations_bytes", "Size of the excluded recommendations bitmaps of the sessions on this replica",
+    ["statistic"]
+)
+
+
+def timed(function, histogram: Histogram):
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+    return wrapper
+
+
+# Wraps every public coroutine method of a class, so calls added later are measured without touching them.
+def instrument_methods(cls: type, histogram: Histogram) -> None:
+    for name, function in list(vars(cls).items()):
+        if name.startswith("_") or not inspect.iscoroutinefunction(function):
+            continue
+        setattr(cls, name, timed(function, histogram.labels(name)))
+
+
+# The song cache counts on its own, its counters are read when scraped.
+class SongCacheCollector:
+    def __init__(self, song_cache: SongCache) -> None:
+        self._song_cache = song_cache
+
+    def collect(self):
+        statistics = self._song_cache.get_statistics()
+        lookups = CounterMetricFamily("song_cache_lookups", "Song cache lookups by the tier that answered them",
+                                      labels=["result"])
+        for result in ("local_hits", "shared_hits", "misses"):
+            lookups.add_metric([result], statistics[result])
+        yield lookups
+        yield CounterMetricFamily("song_cache_evictions", "Songs evicted from the local song cache",
+                                  value=statistics["evictions"])
+        yield GaugeMetricFamily("song_cache_entries", "Songs in the local song cache", value=statistics["entries"])
+        yield GaugeMetricFamily("song_cache_size_bytes", "Size of the songs in the local song cache",
+                                value=statistics["size_bytes"])
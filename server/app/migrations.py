@@ -0,0 +1,249 @@
+from databases import Database
+
+# Arbitrary key for pg_advisory_xact_lock so that replicas booting at the same time apply migrations one after another.
+MIGRATION_LOCK_KEY = 20241018
+
+
+class Migration:
+    def __init__(self, version: int, description: str, statements: list[str]) -> None:
+        self.version = version
+        self.description = description
+        self.statements = statements
+
+    def __repr__(self) -> str:
+        return f"Migration(version={self.version!r}, description={self.description!r})"
+
+
+# Append new migrations at the end, never edit or reorder migrations that have already been released.
+# The first migrations are idempotent on purpose so that databases set up by the former per-boot setup still migrate.
+MIGRATIONS = [
+    Migration(1, "full text search on songs", [
+        """
+        ALTER TABLE songs ADD COLUMN IF NOT EXISTS search_vector tsvector;
+        """,
+        """
+        UPDATE songs
+        SET search_vector = to_tsvector('simple', track_name || ' ' || array_to_string(artists, ' '))
+        WHERE search_vector IS NULL;
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_songs_search_vector
+        ON songs USING gin(search_vector);
+        """
+    ]),
+    Migration(2, "catalog statistics and scaled tempo", [
+        """
+        CREATE MATERIALIZED VIEW IF NOT EXISTS catalog_statistics AS
+        SELECT
+            MIN(tempo) AS min_tempo,
+            MAX(tempo) AS max_tempo,
+            COUNT(*) AS song_count
+        FROM songs;
+        """,
+        """
+        ALTER TABLE songs ADD COLUMN IF NOT EXISTS scaled_tempo double precision;
+        """,
+        """
+        UPDATE songs s
+        SET scaled_tempo = LEAST(GREATEST((s.tempo - cs.min_tempo) / NULLIF(cs.max_tempo - cs.min_tempo, 0), 0), 1)
+        FROM catalog_statistics cs
+        WHERE s.scaled_tempo IS NULL
+          AND s.tempo IS NOT NULL;
+        """
+    ]),
+    Migration(3, "feature cube with GiST index", [
+        """
+        CREATE EXTENSION IF NOT EXISTS cube;
+        """,
+        """
+        ALTER TABLE songs ADD COLUMN IF NOT EXISTS features cube;
+        """,
+        """
+        UPDATE songs
+        SET features = cube(array[danceability, energy, speechiness, valence, scaled_tempo])
+        WHERE features IS NULL
+          AND danceability IS NOT NULL
+          AND energy IS NOT NULL
+          AND speechiness IS NOT NULL
+          AND valence IS NOT NULL
+          AND scaled_tempo IS NOT NULL;
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_songs_features
+        ON songs USING gist(features);
+        """
+    ]),
+    Migration(4, "keep derived song columns current", [
+        """
+        CREATE OR REPLACE FUNCTION songs_derived_columns() RETURNS trigger AS $$
+        DECLARE
+            catalog_min_tempo double precision;
+            catalog_max_tempo double precision;
+        BEGIN
+            NEW.search_vector := to_tsvector('simple', NEW.track_name || ' ' || array_to_string(NEW.artists, ' '));
+
+            SELECT min_tempo, max_tempo INTO catalog_min_tempo, catalog_max_tempo FROM catalog_statistics;
+            NEW.scaled_tempo := LEAST(GREATEST((NEW.tempo - catalog_min_tempo) / NULLIF(catalog_max_tempo - catalog_min_tempo, 0), 0), 1);
+
+            IF NEW.danceability IS NOT NULL
+               AND NEW.energy IS NOT NULL
+               AND NEW.speechiness IS NOT NULL
+               AND NEW.valence IS NOT NULL
+               AND NEW.scaled_tempo IS NOT NULL THEN
+                NEW.features := cube(array[NEW.danceability, NEW.energy, NEW.speechiness, NEW.valence, NEW.scaled_tempo]);
+            ELSE
+                NEW.features := NULL;
+            END IF;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        """
+        DROP TRIGGER IF EXISTS songs_derived_columns ON songs;
+        """,
+        """
+        CREATE TRIGGER songs_derived_columns
+        BEFORE INSERT OR UPDATE OF track_name, artists, danceability, energy, speechiness, valence, tempo ON songs
+        FOR EACH ROW EXECUTE FUNCTION songs_derived_columns();
+        """
+    ]),
+    Migration(5, "ranked and fuzzy song search", [
+        """
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        """,
+        """
+        ALTER TABLE songs ADD COLUMN IF NOT EXISTS search_text text;
+        """,
+        """
+        CREATE OR REPLACE FUNCTION songs_search_vector(track_name text, artists text[], album text) RETURNS tsvector AS $$
+            SELECT setweight(to_tsvector('simple', coalesce(track_name, '')), 'A')
+                || setweight(to_tsvector('simple', coalesce(array_to_string(artists, ' '), '')), 'B')
+                || setweight(to_tsvector('simple', coalesce(album, '')), 'C');
+        $$ LANGUAGE sql IMMUTABLE;
+        """,
+        """
+        CREATE OR REPLACE FUNCTION songs_search_text(track_name text, artists text[]) RETURNS text AS $$
+            SELECT lower(concat_ws(' ', track_name, array_to_string(artists, ' ')));
+        $$ LANGUAGE sql IMMUTABLE;
+        """,
+        """
+        CREATE OR REPLACE FUNCTION songs_derived_columns() RETURNS trigger AS $$
+        DECLARE
+            catalog_min_tempo double precision;
+            catalog_max_tempo double precision;
+        BEGIN
+            NEW.search_vector := songs_search_vector(NEW.track_name, NEW.artists, NEW.album);
+            NEW.search_text := songs_search_text(NEW.track_name, NEW.artists);
+
+            SELECT min_tempo, max_tempo INTO catalog_min_tempo, catalog_max_tempo FROM catalog_statistics;
+            NEW.scaled_tempo := LEAST(GREATEST((NEW.tempo - catalog_min_tempo) / NULLIF(catalog_max_tempo - catalog_min_tempo, 0), 0), 1);
+
+            IF NEW.danceability IS NOT NULL
+               AND NEW.energy IS NOT NULL
+               AND NEW.speechiness IS NOT NULL
+               AND NEW.valence IS NOT NULL
+               AND NEW.scaled_tempo IS NOT NULL THEN
+                NEW.features := cube(array[NEW.danceability, NEW.energy, NEW.speechiness, NEW.valence, NEW.scaled_tempo]);
+            ELSE
+                NEW.features := NULL;
+            END IF;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        """
+        DROP TRIGGER IF EXISTS songs_derived_columns ON songs;
+        """,
+        """
+        CREATE TRIGGER songs_derived_columns
+        BEFORE INSERT OR UPDATE OF track_name, album, artists, danceability, energy, speechiness, valence, tempo ON songs
+        FOR EACH ROW EXECUTE FUNCTION songs_derived_columns();
+        """,
+        """
+        UPDATE songs
+        SET search_vector = songs_search_vector(track_name, artists, album),
+            search_text = songs_search_text(track_name, artists);
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_songs_search_text
+        ON songs USING gin(search_text gin_trgm_ops);
+        """
+    ]),
+    # Dense row numbers, so the songs recommended in a session can be kept as a bitmap in Redis.
+    Migration(6, "catalog row numbers", [
+        """
+        CREATE SEQUENCE IF NOT EXISTS songs_catalog_index_seq AS integer MINVALUE 0 START WITH 0;
+        """,
+        """
+        ALTER TABLE songs ADD COLUMN IF NOT EXISTS catalog_index integer;
+        """,
+        """
+        UPDATE songs
+        SET catalog_index = nextval('songs_catalog_index_seq')
+        WHERE catalog_index IS NULL;
+        """,
+        """
+        ALTER TABLE songs
+        ALTER COLUMN catalog_index SET DEFAULT nextval('songs_catalog_index_seq'),
+        ALTER COLUMN catalog_index SET NOT NULL;
+        """,
+        """
+        ALTER SEQUENCE songs_catalog_index_seq OWNED BY songs.catalog_index;
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_songs_catalog_index
+        ON songs (catalog_index);
+        """
+    ]),
+]
+
+
+class MigrationRunner:
+    def __init__(self, postgres: Database, migrations: list[Migration] = None) -> None:
+        self._postgres = postgres
+        self._migrations = sorted(migrations or MIGRATIONS, key=lambda migration: migration.version)
+
+    async def get_applied_versions(self) -> set[int]:
+        rows = await self._postgres.fetch_all("SELECT version FROM schema_migrations;")
+        return {row["version"] for row in rows}
+
+    async def run(self) -> list[Migration]:
+        await self._postgres.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version integer PRIMARY KEY,
+                description text NOT NULL,
+                applied_at timestamptz NOT NULL DEFAULT now()
+            );
+            """
+        )
+
+        applied_versions = await self.get_applied_versions()
+        applied = []
+        for migration in self._migrations:
+            if migration.version in applied_versions:
+                continue
+            if await self._apply(migration):
+                applied.append(migration)
+        return applied
+
+    async def _apply(self, migration: Migration) -> bool:
+        async with self._postgres.connection() as connection:
+            async with connection.transaction():
+                await connection.execute("SELECT pg_advisory_xact_lock(:key);", {"key": MIGRATION_LOCK_KEY})
+                # another replica may have applied the migration while we were waiting for the lock
+                already_applied = await connection.fetch_val(
+                    "SELECT EXISTS(SELECT 1 FROM schema_migrations WHERE version = :version);",
+                    {"version": migration.version}
+                )
+                if already_applied:
+                    return False
+
+                for statement in migration.statements:
+                    await connection.execute(statement)
+                await connection.execute(
+                    "INSERT INTO schema_migrations (version, description) VALUES (:version, :description);",
+                    {"version": migration.version, "description": migration.description}
+                )
+        print(f"Applied schema migration {migration.version}: {migration.description}")
+        return True
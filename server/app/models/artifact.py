@@ -11,6 +11,15 @@ class AverageFeatures(CamelModel):
     scaled_tempo: float
 
 
+# Features of the played songs over the course of the session, averaged over consecutive songs for long sessions.
+class FeatureTrajectory(CamelModel):
+    danceability: list[float] = []
+    energy: list[float] = []
+    speechiness: list[float] = []
+    valence: list[float] = []
+    scaled_tempo: list[float] = []
+
+
 class Artifact(CamelModel):
     songs_played: int
     songs_added_manually: int
@@ -19,5 +28,6 @@ class Artifact(CamelModel):
     most_significant_feature_overall: Optional[str] = None
     first_recommendation_vote_percentage: float
     average_features: AverageFeatures
+    feature_trajectory: FeatureTrajectory = FeatureTrajectory()
     genre_start: Optional[list[str]] = None
     genre_end: Optional[list[str]] = None
@@ -0,0 +1,11 @@
+from .camel_model import CamelModel
+
+
+class CatalogStatistics(CamelModel):
+    min_tempo: float
+    max_tempo: float
+    song_count: int = 0
+
+    def scale_tempo(self, tempo: float) -> float:
+        tempo_range = (self.max_tempo - self.min_tempo) or 1.0
+        return min(max((tempo - self.min_tempo) / tempo_range, 0.0), 1.0)
@@ -0,0 +1,61 @@
+from datetime import datetime
+from typing import Literal, Optional, Union
+
+from .camel_model import CamelModel
+from .user import User
+from .song import Song, SongList, Playlist
+from .session import SessionCore
+
+
+# Websocket events only describe what changed. Every event carries the sequence number of its topic within the
+# session, so clients can detect a gap and ask for a snapshot of the current state instead.
+class Delta(CamelModel):
+    seq: int = 0
+    type: str
+
+
+class Snapshot(Delta):
+    type: Literal['snapshot'] = 'snapshot'
+    data: Union[SessionCore, Playlist, SongList]
+
+
+class GuestJoined(Delta):
+    type: Literal['guest_joined'] = 'guest_joined'
+    guest: User
+
+
+class GuestLeft(Delta):
+    type: Literal['guest_left'] = 'guest_left'
+    guest_id: str
+
+
+class SongQueued(Delta):
+    type: Literal['song_queued'] = 'song_queued'
+    song: Song
+
+
+class SongRemoved(Delta):
+    type: Literal['song_removed'] = 'song_removed'
+    song_id: str
+
+
+class PlaylistAdvanced(Delta):
+    # the former current song moves to the played songs and the head of the queue becomes the current song
+    type: Literal['playlist_advanced'] = 'playlist_advanced'
+    current_song: Song
+
+
+class RecommendationsReplaced(Delta):
+    type: Literal['recommendations_replaced'] = 'recommendations_replaced'
+    songs: list[Song]
+    voting_start_time: Optional[datetime] = None
+
+
+class VoteChange(CamelModel):
+    guest_id: str
+    song_id: Optional[str] = None  # None if the guest withdrew the vote
+
+
+class VotesChanged(Delta):
+    type: Literal['votes_changed'] = 'votes_changed'
+    changes: list[VoteChange]
@@ -1,14 +1,18 @@
-from pydantic import model_validator
+from pydantic import Field, model_validator
 from datetime import datetime
 from typing import Optional
 from .user import User
+from .catalog import CatalogStatistics
 from .camel_model import CamelModel
 
-# scheiss idiotische approach zum arbiträr values setze aber you do you.
-# mit de neue DB hemmer immerhin ermittleti wert womer üs sicher chönd si was max und was min isch
-# Approximate values for maximum and minimum values of tempo.
-MAX_TEMPO = 236
-MIN_TEMPO = 0
+# Tempo range of the song catalog. Replaced by the values of the catalog_statistics view on startup,
+# the approximate defaults are only used until then.
+catalog_statistics = CatalogStatistics(min_tempo=0, max_tempo=236)
+
+
+def set_catalog_statistics(statistics: CatalogStatistics) -> None:
+    global catalog_statistics
+    catalog_statistics = statistics
 
 
 class Song(CamelModel):
@@ -27,6 +31,8 @@ class Song(CamelModel):
     duration_ms: Optional[int] = None
     release_date: Optional[datetime] = None
     popularity: Optional[float] = None
+    # row number of the song in the catalog, only known for songs loaded from the database and never serialized
+    catalog_index: Optional[int] = Field(default=None, exclude=True)
     # below this: added manually (not in database)
     genre: list[str] = []
     preview_url: Optional[str] = None
@@ -38,16 +44,16 @@ class Song(CamelModel):
 
     @model_validator(mode='after')
     def set_scaled_tempo(self) -> 'Song':
-        # mit de ermittlete wert muesches au nüm so komplett hirngschisse clampe
-        self.scaled_tempo = (self.tempo - MIN_TEMPO) / (MAX_TEMPO - MIN_TEMPO)
-        # Clamp between 0 and 1
-        # self.scaled_tempo = max(0, min(scaled_tempo, 1))
+        # songs loaded from the database already carry the persisted scaled_tempo column
+        if self.scaled_tempo is None and self.tempo is not None:
+            self.scaled_tempo = catalog_statistics.scale_tempo(self.tempo)
         return self
 
 
 class SongList(CamelModel):
     songs: list[Song] = []
     voting_start_time: Optional[datetime] = None
+    next_cursor: Optional[str] = None
 
 
 class Playlist(CamelModel):
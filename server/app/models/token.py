@@ -11,3 +11,7 @@ class SpotifyToken(Token):
     expires_in: Optional[int] = None
     refresh_token: Optional[str] = None
     scope: Optional[str] = None
+
+
+class SpotifyRefresh(CamelModel):
+    refresh_token: str
@@ -0,0 +1,143 @@
+import asyncio
+import os
+
+from redis.asyncio import Redis
+from typing import Awaitable, Callable
+
+AUTOMATION_INTERVAL_SECONDS = float(os.getenv("AUTOMATION_INTERVAL_SECONDS") or 30)
+AUTOMATION_LEASE_SECONDS = float(os.getenv("AUTOMATION_LEASE_SECONDS") or 60)
+AUTOMATION_WORKERS = int(os.getenv("AUTOMATION_WORKERS") or 256)
+AUTOMATION_POLL_SECONDS = float(os.getenv("AUTOMATION_POLL_SECONDS") or 1)
+SCHEDULE_KEY = 'sessions:automation'
+
+# All scripts use the clock of Redis, so replicas with skewed clocks agree on what is due.
+REDIS_NOW_MS = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+"""
+
+# KEYS: schedule
+# ARGV: session id, delay in milliseconds, 'NX' to keep an existing due time
+SCHEDULE = REDIS_NOW_MS + """
+if ARGV[3] == 'NX' then
+    return redis.call('ZADD', KEYS[1], 'NX', now + tonumber(ARGV[2]), ARGV[1])
+end
+return redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[1])
+"""
+
+# Claims up to a limit of due sessions by moving their due time to the end of the lease. A session whose worker
+# dies becomes due again once the lease has run out. The new due time doubles as the claim token.
+# KEYS: schedule
+# ARGV: lease in milliseconds, limit
+CLAIM = REDIS_NOW_MS + """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, tonumber(ARGV[2]))
+local claims = {}
+local lease_end = now + tonumber(ARGV[1])
+for _, session_id in ipairs(due) do
+    redis.call('ZADD', KEYS[1], lease_end, session_id)
+    claims[#claims + 1] = session_id
+    claims[#claims + 1] = tostring(lease_end)
+end
+return claims
+"""
+
+# Moves the due time of a claimed session, as long as the claim is still held. Sessions that were unscheduled or
+# claimed by another worker in the meantime are left alone. Returns the new due time or 0.
+# KEYS: schedule
+# ARGV: session id, claim token, delay in milliseconds from now or absolute due time if ARGV[4] is 'AT'
+RESCHEDULE = REDIS_NOW_MS + """
+if tonumber(redis.call('ZSCORE', KEYS[1], ARGV[1])) ~= tonumber(ARGV[2]) then
+    return 0
+end
+local due = tonumber(ARGV[3])
+if ARGV[4] ~= 'AT' then
+    due = now + due
+end
+redis.call('ZADD', KEYS[1], 'XX', due, ARGV[1])
+return due
+"""
+
+
+# Playlist automation that survives restarts and spreads over any number of replicas. The due time of every session
+# is kept in a Redis sorted set. Every replica polls it and claims due sessions with a lease, up to a bounded number
+# of concurrent runs. After a run, the session is due again one interval after the run started.
+class PlaylistScheduler:
+    def __init__(self, redis: Redis, run: Callable[[str], Awaitable[bool]],
+                 interval_seconds: float = AUTOMATION_INTERVAL_SECONDS, lease_seconds: float = AUTOMATION_LEASE_SECONDS,
+                 workers: int = AUTOMATION_WORKERS, poll_seconds: float = AUTOMATION_POLL_SECONDS) -> None:
+        self._redis = redis
+        self._run = run  # returns False if the session should not be automated anymore
+        self._interval_ms = int(interval_seconds * 1000)
+        self._lease_ms = int(lease_seconds * 1000)
+        self._workers = workers
+        self._poll_seconds = poll_seconds
+        self._schedule = redis.register_script(SCHEDULE)
+        self._claim = redis.register_script(CLAIM)
+        self._reschedule = redis.register_script(RESCHEDULE)
+        self._running: set[asyncio.Task] = set()
+        self._poller: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._running)
+
+    async def schedule(self, session_id: str, delay_seconds: float | None = None, keep_existing: bool = False) -> None:
+        delay_ms = self._interval_ms if delay_seconds is None else int(delay_seconds * 1000)
+        await self._schedule(keys=[SCHEDULE_KEY], args=[session_id, delay_ms, 'NX' if keep_existing else ''])
+
+    async def unschedule(self, session_id: str) -> None:
+        await self._redis.zrem(SCHEDULE_KEY, session_id)
+
+    def start(self) -> None:
+        if self._poller is None:
+            self._poller = asyncio.create_task(self._poll())
+
+    async def stop(self) -> None:
+        # Interrupted runs are rescheduled like finished ones, so another replica continues without waiting for
+        # the leases to run out.
+        tasks = [task for task in (self._poller, *self._running) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._poller = None
+
+    async def _poll(self) -> None:
+        while True:
+            free = self._workers - len(self._running)
+            if free <= 0:
+                await asyncio.wait(self._running, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            try:
+                claims = await self._claim(keys=[SCHEDULE_KEY], args=[self._lease_ms, free])
+            except Exception as e:
+                print(f"Could not claim due sessions: {repr(e)}")
+                claims = []
+            for session_id, token in zip(claims[::2], claims[1::2]):
+                task = asyncio.create_task(self._run_claimed(session_id, token))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+            if len(claims) // 2 < free:  # nothing else is due right now
+                await asyncio.sleep(self._poll_seconds)
+
+    async def _keep_alive(self, session_id: str, claim: list[str]) -> None:
+        while True:
+            await asyncio.sleep(self._lease_ms / 3000)
+            token = await self._reschedule(keys=[SCHEDULE_KEY], args=[session_id, claim[0], self._lease_ms])
+            if not token:
+                return  # unscheduled or claimed by another worker after our lease ran out
+            claim[0] = str(token)
+
+    async def _run_claimed(self, session_id: str, token: str) -> None:
+        claim = [token]
+        next_due = int(token) - self._lease_ms + self._interval_ms
+        keep_alive = asyncio.create_task(self._keep_alive(session_id, claim))
+        keep_scheduled = True
+        try:
+            keep_scheduled = await self._run(session_id)
+        except Exception as e:
+            print(f"Could not automate playlist of session {session_id}: {repr(e)}")
+        finally:
+            keep_alive.cancel()
+            if keep_scheduled:
+                await self._reschedule(keys=[SCHEDULE_KEY], args=[session_id, claim[0], next_due, 'AT'])
+            else:
+                await self._redis.zrem(SCHEDULE_KEY, session_id)
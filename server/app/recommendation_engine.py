@@ -0,0 +1,75 @@
+import numpy as np
+
+from databases import Database
+
+FEATURES = ("danceability", "energy", "speechiness", "valence", "tempo")
+COLUMNS = ("danceability", "energy", "speechiness", "valence", "scaled_tempo")
+
+
+class NumpyRecommendationEngine:
+    def __init__(self):
+        self._ids = np.empty(0, dtype=object)
+        self._features = np.empty((0, len(FEATURES)), dtype=np.float32)
+        self._catalog_indexes = np.empty(0, dtype=np.intp)
+
+    @property
+    def size(self) -> int:
+        return len(self._ids)
+
+    async def load(self, postgres: Database) -> None:
+        rows = await postgres.fetch_all(
+            """
+            SELECT id, catalog_index, danceability, energy, speechiness, valence, scaled_tempo
+            FROM songs
+            WHERE danceability IS NOT NULL
+              AND energy IS NOT NULL
+              AND speechiness IS NOT NULL
+              AND valence IS NOT NULL
+              AND scaled_tempo IS NOT NULL;
+            """
+        )
+        self.build(
+            [row["id"] for row in rows],
+            [[row[column] for column in COLUMNS] for row in rows],
+            [row["catalog_index"] for row in rows]
+        )
+
+    def build(self, ids: list[str], features: list[list[float]], catalog_indexes: list[int] = None) -> None:
+        # tempo is expected to be normalized already (songs.scaled_tempo)
+        self._features = np.ascontiguousarray(np.reshape(features, (-1, len(FEATURES))), dtype=np.float32)
+        self._ids = np.array(ids, dtype=object)
+        self._catalog_indexes = np.array(range(len(ids)) if catalog_indexes is None else catalog_indexes, dtype=np.intp)
+
+    def _excluded_rows(self, excluded: bytes) -> np.ndarray:
+        # Redis numbers the bits of a bitmap from the most significant bit of the first byte, as unpackbits does.
+        bits = np.unpackbits(np.frombuffer(excluded, dtype=np.uint8)).astype(bool)
+        in_bitmap = self._catalog_indexes < bits.size
+        rows = np.zeros(self.size, dtype=bool)
+        rows[in_bitmap] = bits[self._catalog_indexes[in_bitmap]]
+        return rows
+
+    # target holds the features to get close to, excluded is a bitmap over the catalog indexes of songs that must
+    # not be recommended
+    def recommend(self, target: list[float], excluded: bytes, limit: int) -> list[dict]:
+        if not self.size or limit <= 0:
+            return []
+
+        diffs = self._features - np.asarray(target, dtype=np.float32)
+        distances = np.einsum("ij,ij->i", diffs, diffs)
+        if excluded:
+            distances[self._excluded_rows(excluded)] = np.inf
+
+        k = min(limit, distances.size)
+        candidates = np.argpartition(distances, k - 1)[:k]
+        candidates = candidates[np.argsort(distances[candidates], kind="stable")]
+        candidates = candidates[np.isfinite(distances[candidates])]
+
+        return [
+            {
+                "id": self._ids[row],
+                "catalog_index": int(self._catalog_indexes[row]),
+                **{f"diff_{feature}": float(abs(diffs[row, col])) for col, feature in enumerate(FEATURES)},
+                "cosine_distance": float(np.sqrt(distances[row]))
+            }
+            for row in candidates
+        ]
@@ -1,15 +1,32 @@
+import math
+import orjson
+import os
+import re
+import time
+
+from contextlib import asynccontextmanager
 from databases import Database
 from databases.interfaces import Record
 from fastapi import HTTPException, status
+from datetime import datetime
 from redis.asyncio import Redis
-from sqlalchemy import Column, Table, MetaData, Integer, String, ARRAY, Float, Date, insert, select, func
+from redis.asyncio.client import Pipeline
+from redis.client import NEVER_DECODE
+from redis.commands.core import AsyncScript
+from redis.exceptions import WatchError
+from sqlalchemy import Column, Table, MetaData, Integer, String, ARRAY, Float, Date, insert, select, func, case, cast, literal, or_, and_
 from sqlalchemy.dialects.postgresql import TSVECTOR
-from typing import Optional
-from collections import defaultdict
+from typing import AsyncIterator, Optional
 
-from models.session import Session
+from models.catalog import CatalogStatistics
+from models.session import SessionCore, Session
 from models.user import User
-from models.song import Song
+from models.song import Song, Playlist, set_catalog_statistics
+from recommendation_engine import NumpyRecommendationEngine, COLUMNS as FEATURE_COLUMNS
+from session_lock import SessionLease, fencing_token
+from session_codec import EncodedSongs, SongDecoder, get_session_codec, JsonSessionCodec, CompactSessionCodec
+from song_cache import SongCache
+import session_scripts
 
 metadata = MetaData()
 songs = Table(
@@ -26,20 +43,46 @@ songs = Table(
     Column("speechiness", Float),
     Column("valence", Float),
     Column("tempo", Float),
+    Column("scaled_tempo", Float, nullable=True),  # tempo normalized with the catalog_statistics view
     Column("duration_ms", Integer),
     Column("release_date", Date, nullable=True), # No more release_date. Migrate all fields to Null
     Column("popularity", Float, nullable=True), # No more popularity. Migrate all fields to Null
+    Column("catalog_index", Integer),  # row number of the song, used as its bit in the recommendation bitmaps
     Column("genre", ARRAY(String)), # Newly available. Could change code to use this instead of DiscogsAPI
     Column("preview_url", String), # Newly available. Need to change code to use this instead of SpotifyAPI
-    Column("search_vector", TSVECTOR, nullable=True)
+    Column("search_vector", TSVECTOR, nullable=True),
+    Column("search_text", String, nullable=True)  # lower-cased track name and artists for trigram matching
 )
 
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS") or 24 * 60 * 60)
+USER_TTL_SECONDS = int(os.getenv("USER_TTL_SECONDS") or 24 * 60 * 60)
+ACTIVITY_KEY = 'sessions:activity'  # session id to the time of its last activity
+
+SESSION_META_FIELDS = {'id', 'name', 'host_id', 'host_name', 'invite_link', 'creation_date', 'voting_start_time'}
+
 
 class Repository:
-    def __init__(self, postgres: Database, redis: Redis):
+    def __init__(self, postgres: Database, redis: Redis, recommendation_engine: Optional[NumpyRecommendationEngine] = None,
+                 song_cache: Optional[SongCache] = None, codec: Optional[JsonSessionCodec | CompactSessionCodec] = None):
         self.redis = redis
+        self.codec = codec or get_session_codec()
         self.postgres = postgres
-        self.marked_recommendations = defaultdict(set)
+        self.recommendation_engine = recommendation_engine
+        self.song_cache = song_cache or SongCache(redis)
+
+        self.load_session_script = redis.register_script(session_scripts.LOAD_SESSION)
+        self.load_playlist_script = redis.register_script(session_scripts.LOAD_PLAYLIST)
+        self.load_recommendations_script = redis.register_script(session_scripts.LOAD_RECOMMENDATIONS)
+        self.add_or_change_vote_script = redis.register_script(session_scripts.ADD_OR_CHANGE_VOTE)
+        self.remove_vote_script = redis.register_script(session_scripts.REMOVE_VOTE)
+        self.replace_recommendations_script = redis.register_script(session_scripts.REPLACE_RECOMMENDATIONS)
+        self.advance_queue_script = redis.register_script(session_scripts.ADVANCE_QUEUE)
+        self.queue_if_empty_script = redis.register_script(session_scripts.QUEUE_IF_EMPTY)
+        self.remove_queued_song_script = redis.register_script(session_scripts.REMOVE_QUEUED_SONG)
+        self.delete_session_script = redis.register_script(session_scripts.DELETE_SESSION)
+        self.next_event_seq_script = redis.register_script(session_scripts.NEXT_EVENT_SEQ)
+        self.touch_session_script = redis.register_script(session_scripts.TOUCH_SESSION)
+        self.claim_idle_session_script = redis.register_script(session_scripts.CLAIM_IDLE_SESSION)
 
     @staticmethod
     def get_user_key(user_id) -> str:
@@ -47,70 +90,492 @@ class Repository:
 
     @staticmethod
     def get_session_key(session_id) -> str:
-        return f'session:{session_id}'
+        # The session id is a hash tag, so all keys of one session end up in the same cluster slot and
+        # can be used together in one Lua script.
+        return f'session:{{{session_id}}}'
+
+    def get_session_subkey(self, session_id: str, name: str) -> str:
+        return f'{self.get_session_key(session_id)}:{name}'
 
+    def get_session_keys(self, session_id: str) -> dict[str, str]:
+        return {
+            'meta': self.get_session_key(session_id),
+            'guests': self.get_session_subkey(session_id, 'guests'),
+            'played': self.get_session_subkey(session_id, 'played'),
+            'current': self.get_session_subkey(session_id, 'current'),
+            'queue': self.get_session_subkey(session_id, 'queue'),
+            'recommendations': self.get_session_subkey(session_id, 'recommendations'),
+            'recommended': self.get_session_subkey(session_id, 'recommended'),
+            'excluded': self.get_session_subkey(session_id, 'excluded'),
+            'target': self.get_session_subkey(session_id, 'target'),
+            'speculations': self.get_session_subkey(session_id, 'speculations'),
+            'voters': self.get_session_subkey(session_id, 'voters'),
+            'songs': self.get_session_subkey(session_id, 'songs'),
+            'users': self.get_session_subkey(session_id, 'users'),
+            'seq': self.get_session_subkey(session_id, 'seq')
+        }
+
+    def get_votes_key_prefix(self, session_id: str) -> str:
+        return self.get_session_subkey(session_id, 'votes:')
+
+    # Users and sessions expire unless they are used. Every read or verification slides their expiry.
     async def set_user(self, user: User) -> None:
-        await self.redis.set(self.get_user_key(user.id), user.model_dump_json())
+        await self.redis.set(self.get_user_key(user.id), user.model_dump_json(), ex=USER_TTL_SECONDS)
+
+    async def get_users_by_ids(self, user_ids: list[str]) -> list[Optional[str]]:
+        if not user_ids:
+            return []
+        return await self.redis.mget([self.get_user_key(user_id) for user_id in user_ids])
+
+    @staticmethod
+    def encode_session_meta(session: SessionCore | Session) -> dict[str, str]:
+        meta = session.model_dump(mode='json', include=SESSION_META_FIELDS, exclude_none=True)
+        return {field: str(value) for field, value in meta.items()}
 
-    async def get_user_by_id(self, user_id: str) -> Optional[bytes]:
-        return await self.redis.get(self.get_user_key(user_id))
+    def encode_recommendation(self, song: Song) -> str:
+        # votes live in their own sets, the metadata stays inline as recommendations are replaced every round
+        return self.codec.encode_song(song, include_votes=False, inline_metadata=True)
 
-    async def verify_user_by_id(self, user_id: str) -> None:
-        if await self.redis.exists(self.get_user_key(user_id)) == 0:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authorized! Invalid user ID.")
+    @staticmethod
+    def decode_user(data: str) -> User:
+        return User.model_validate_json(data)
+
+    @staticmethod
+    def decode_songs(reply: list, decoder: SongDecoder) -> list[Song]:
+        # flat list of song, metadata and user as returned by songs_with_references
+        return [decoder.decode_song(*reply[i:i + 3]) for i in range(0, len(reply), 3)]
+
+    @staticmethod
+    def decode_playlist(played: list, current: list, queue: list) -> Playlist:
+        decoder = SongDecoder()
+        current_songs = Repository.decode_songs(current, decoder)
+        return Playlist(
+            played_songs=Repository.decode_songs(played, decoder),
+            current_song=current_songs[0] if current_songs else None,
+            queued_songs=Repository.decode_songs(queue, decoder)
+        )
+
+    @staticmethod
+    def decode_recommendations(reply: list) -> list[Song]:
+        decoder = SongDecoder()
+        recommendations = []
+        for data, votes in zip(reply[::2], reply[1::2]):
+            song = decoder.decode_song(data)
+            song.votes = sorted(votes)
+            recommendations.append(song)
+        return recommendations
+
+    def write_songs(self, pipe: Pipeline, keys: dict[str, str], encoded: EncodedSongs) -> None:
+        if encoded.metadata:
+            pipe.hset(keys['songs'], mapping=encoded.metadata)
+        if encoded.users:
+            pipe.hset(keys['users'], mapping=encoded.users)
+
+    @asynccontextmanager
+    async def fenced_pipeline(self, session_id: str) -> AsyncIterator[Pipeline]:
+        # Under a session lease, the transaction only runs while the token of the caller is the latest of the session.
+        # A holder whose lease expired and was taken over by another replica cannot overwrite the newer state.
+        async with self.redis.pipeline(transaction=True) as pipe:
+            token = fencing_token.get()
+            if token is not None:
+                fence_key = SessionLease.get_lease_keys(session_id)[1]
+                await pipe.watch(fence_key)
+                if int(await pipe.get(fence_key) or 0) != token:
+                    raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Session lease expired, try again.")
+                pipe.multi()
+            try:
+                yield pipe
+            except WatchError:
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Session lease expired, try again.")
 
     async def set_session(self, session: Session) -> None:
-        await self.redis.set(self.get_session_key(session.id), session.model_dump_json())
+        keys = self.get_session_keys(session.id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            await self._delete_session(session.id, pipe)
+            pipe.hset(keys['meta'], mapping=self.encode_session_meta(session))
+            if session.guests:
+                pipe.hset(keys['guests'], mapping={guest_id: guest.model_dump_json() for guest_id, guest in session.guests.items()})
+            played = self.codec.encode_songs(session.playlist.played_songs)
+            current = self.codec.encode_songs([session.playlist.current_song] if session.playlist.current_song else [])
+            queued = self.codec.encode_songs(session.playlist.queued_songs)
+            for encoded in (played, current, queued):
+                self.write_songs(pipe, keys, encoded)
+            if played.elements:
+                pipe.rpush(keys['played'], *played.elements)
+            if current.elements:
+                pipe.set(keys['current'], current.elements[0])
+            if queued.elements:
+                pipe.rpush(keys['queue'], *queued.elements)
+            playlist_songs = session.playlist.get_all_songs()
+            self.add_to_target(pipe, keys, await self.get_target_increments([song.id for song in playlist_songs]))
+            self.exclude_songs(pipe, keys, await self.get_catalog_indexes(playlist_songs))
+            await self.set_recommendations(session.id, session.recommendations, pipe)
+            for recommendation in session.recommendations:
+                for guest_id in recommendation.votes:
+                    pipe.sadd(self.get_votes_key_prefix(session.id) + recommendation.id, guest_id)
+                    pipe.hset(keys['voters'], guest_id, recommendation.id)
+            await self._touch_session(session.id, pipe)
+            pipe.zadd(ACTIVITY_KEY, {session.id: time.time()})
+            await pipe.execute()
 
-    async def get_session_by_id(self, session_id: str) -> Optional[bytes]:
-        return await self.redis.get(self.get_session_key(session_id))
+    async def _load_session(self, session_id: str, client: Optional[Pipeline] = None):
+        keys = self.get_session_keys(session_id)
+        return await self.load_session_script(
+            keys=[keys['meta'], keys['guests'], keys['played'], keys['current'], keys['queue'], keys['recommendations'],
+                  keys['songs'], keys['users']],
+            args=[self.get_votes_key_prefix(session_id)],
+            client=client
+        )
 
-    async def get_session_by_key(self, session_key: str) -> Optional[bytes]:
-        return await self.redis.get(session_key)
+    async def get_session_by_id(self, session_id: str) -> Optional[Session]:
+        return self.decode_session(await self._load_session(session_id))
 
-    def get_all_sessions_by_pattern(self):
-        return self.redis.scan_iter(match='session:*')
+    def decode_session(self, reply: list) -> Optional[Session]:
+        if not reply:
+            return None
+        meta, guests, played, current, queue, recommendations = reply
+        return Session(
+            **dict(zip(meta[::2], meta[1::2])),
+            guests={guest_id: self.decode_user(guest) for guest_id, guest in zip(guests[::2], guests[1::2])},
+            playlist=self.decode_playlist(played, current, queue),
+            recommendations=self.decode_recommendations(recommendations)
+        )
+
+    async def get_session_core(self, session_id: str) -> Optional[SessionCore]:
+        keys = self.get_session_keys(session_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(keys['meta'])
+            pipe.hgetall(keys['guests'])
+            meta, guests = await pipe.execute()
+        if not meta:
+            return None
+        meta.pop('voting_start_time', None)
+        return SessionCore(**meta, guests={guest_id: self.decode_user(guest) for guest_id, guest in guests.items()})
 
-    async def verify_session_by_id(self, session_id: str) -> None:
-        if await self.redis.exists(self.get_session_key(session_id)) == 0:
+    async def get_session_membership(self, session_id: str, user_id: str) -> tuple[Optional[str], bool]:
+        # host id of the session and whether the user is a guest of it
+        keys = self.get_session_keys(session_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hget(keys['meta'], 'host_id')
+            pipe.hexists(keys['guests'], user_id)
+            host_id, is_guest = await pipe.execute()
+        return host_id, bool(is_guest)
+
+    async def get_playlist(self, session_id: str) -> Playlist:
+        keys = self.get_session_keys(session_id)
+        played, current, queue = await self.load_playlist_script(
+            keys=[keys['played'], keys['current'], keys['queue'], keys['songs'], keys['users']]
+        )
+        return self.decode_playlist(played, current, queue)
+
+    async def get_recommendations(self, session_id: str) -> list[Song]:
+        reply = await self.load_recommendations_script(
+            keys=[self.get_session_keys(session_id)['recommendations']],
+            args=[self.get_votes_key_prefix(session_id)]
+        )
+        return self.decode_recommendations(reply)
+
+    async def set_recommendations(self, session_id: str, recommendations: list[Song], client: Optional[Pipeline] = None) -> None:
+        if client is None:
+            async with self.fenced_pipeline(session_id) as pipe:
+                await self.set_recommendations(session_id, recommendations, pipe)
+                await pipe.execute()
+            return
+        keys = self.get_session_keys(session_id)
+        args = [self.get_votes_key_prefix(session_id)]
+        for recommendation in recommendations:
+            args.extend([recommendation.id, self.encode_recommendation(recommendation)])
+        await self.replace_recommendations_script(
+            keys=[keys['recommendations'], keys['recommended'], keys['voters'], keys['seq']], args=args, client=client
+        )
+
+    async def set_voting_start_time(self, session_id: str, voting_start_time: datetime) -> None:
+        async with self.fenced_pipeline(session_id) as pipe:
+            pipe.hset(self.get_session_key(session_id), 'voting_start_time', voting_start_time.isoformat())
+            await pipe.execute()
+
+    async def get_voting_start_time(self, session_id: str) -> Optional[datetime]:
+        voting_start_time = await self.redis.hget(self.get_session_key(session_id), 'voting_start_time')
+        return datetime.fromisoformat(voting_start_time) if voting_start_time else None
+
+    async def next_event_seq(self, session_id: str, topic: str) -> int:
+        # 0 if the session does not exist (anymore)
+        keys = self.get_session_keys(session_id)
+        return await self.next_event_seq_script(keys=[keys['meta'], keys['seq']], args=[topic])
+
+    async def get_event_seq(self, session_id: str, topic: str) -> int:
+        return int(await self.redis.hget(self.get_session_keys(session_id)['seq'], topic) or 0)
+
+    async def add_guest(self, session_id: str, guest: User) -> bool:
+        async with self.fenced_pipeline(session_id) as pipe:
+            pipe.hsetnx(self.get_session_keys(session_id)['guests'], guest.id, guest.model_dump_json())
+            added, = await pipe.execute()
+        return bool(added)
+
+    async def remove_guest(self, session_id: str, guest_id: str) -> bool:
+        async with self.fenced_pipeline(session_id) as pipe:
+            pipe.hdel(self.get_session_keys(session_id)['guests'], guest_id)
+            removed, = await pipe.execute()
+        return bool(removed)
+
+    async def queue_song(self, session_id: str, song: Song) -> None:
+        keys = self.get_session_keys(session_id)
+        encoded = self.codec.encode_songs([song])
+        catalog_indexes = await self.get_catalog_indexes([song])
+        increments = await self.get_target_increments([song.id])
+        async with self.fenced_pipeline(session_id) as pipe:
+            self.write_songs(pipe, keys, encoded)
+            pipe.rpush(keys['queue'], encoded.elements[0])
+            self.add_to_target(pipe, keys, increments)
+            self.exclude_songs(pipe, keys, catalog_indexes)
+            await pipe.execute()
+
+    async def queue_song_if_empty(self, session_id: str, song: Song) -> bool:
+        # only recommendations are queued this way, they are excluded from later recommendations already
+        keys = self.get_session_keys(session_id)
+        encoded = self.codec.encode_songs([song])
+        user_id = song.added_by.id if song.added_by else ''
+        args = [encoded.elements[0], song.id, encoded.metadata.get(song.id, ''), user_id, encoded.users.get(user_id, '')]
+        for field, increment in (await self.get_target_increments([song.id])).items():
+            args.extend([field, increment])
+        async with self.fenced_pipeline(session_id) as pipe:
+            await self.queue_if_empty_script(keys=[keys['queue'], keys['songs'], keys['users'], keys['target']], args=args, client=pipe)
+            queued, = await pipe.execute()
+        return bool(queued)
+
+    async def remove_queued_song(self, session_id: str, song_id: str) -> bool:
+        # The song stays excluded from recommendations, the host did not want it in the playlist.
+        keys = self.get_session_keys(session_id)
+        args = [song_id]
+        for field, increment in (await self.get_target_increments([song_id], sign=-1)).items():
+            args.extend([field, increment])
+        async with self.fenced_pipeline(session_id) as pipe:
+            await self.remove_queued_song_script(keys=[keys['queue'], keys['target']], args=args, client=pipe)
+            removed, = await pipe.execute()
+        return bool(removed)
+
+    async def advance_queue(self, session_id: str) -> bool:
+        keys = self.get_session_keys(session_id)
+        async with self.fenced_pipeline(session_id) as pipe:
+            await self.advance_queue_script(keys=[keys['meta'], keys['played'], keys['current'], keys['queue']], client=pipe)
+            advanced, = await pipe.execute()
+        return bool(advanced)
+
+    async def _run_vote_script(self, script: AsyncScript, guest_id: str, session_id: str, song_id: str) -> list[Song]:
+        keys = self.get_session_keys(session_id)
+        reply = await script(
+            keys=[keys['meta'], keys['guests'], keys['recommended'], keys['voters'], keys['recommendations']],
+            args=[guest_id, song_id, self.get_votes_key_prefix(session_id)]
+        )
+        if reply[0] == session_scripts.VOTE_SESSION_NOT_FOUND:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Invalid session ID.")
+        if reply[0] == session_scripts.VOTE_NOT_A_GUEST:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Guest not part of session.")
+        if reply[0] == session_scripts.VOTE_NOT_RECOMMENDED:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Song is not recommended.")
+        if reply[0] == session_scripts.VOTE_NOT_FOUND:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No vote added prior.")
+        return self.decode_recommendations(reply[1])
+
+    async def add_or_change_vote(self, guest_id: str, session_id: str, song_id: str) -> list[Song]:
+        return await self._run_vote_script(self.add_or_change_vote_script, guest_id, session_id, song_id)
+
+    async def remove_vote(self, guest_id: str, session_id: str, song_id: str) -> list[Song]:
+        return await self._run_vote_script(self.remove_vote_script, guest_id, session_id, song_id)
+
+    def get_all_sessions_by_pattern(self):
+        return self.redis.scan_iter(match=self.get_session_key('*'))
+
+    # Fetches the users of a request and records activity in its session in one round trip, instead of verifying
+    # every key on its own and reading the users again afterwards. Missing users are None.
+    async def load_instances(self, user_ids: list[str], session_id: str = "",
+                             full_session: bool = False) -> tuple[list[Optional[str]], bool, Optional[Session]]:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.getex(self.get_user_key(user_id), ex=USER_TTL_SECONDS)
+            if session_id:
+                await self._touch_session(session_id, pipe)
+                pipe.zadd(ACTIVITY_KEY, {session_id: time.time()}, xx=True)
+                if full_session:
+                    await self._load_session(session_id, pipe)
+            reply = await pipe.execute()
+        users, session_reply = reply[:len(user_ids)], reply[len(user_ids):]
+        session = self.decode_session(session_reply[2]) if full_session and session_reply else None
+        session_exists = bool(session_reply) and bool(session_reply[0]) and (session is not None or not full_session)
+        return users, session_exists, session
+
+    async def session_exists(self, session_id: str) -> bool:
+        return await self.redis.exists(self.get_session_key(session_id)) > 0
+
+    async def get_existing_sessions(self, session_ids: list[str]) -> set[str]:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for session_id in session_ids:
+                pipe.exists(self.get_session_key(session_id))
+            exists = await pipe.execute()
+        return {session_id for session_id, count in zip(session_ids, exists) if count}
+
+    async def _touch_session(self, session_id: str, client: Pipeline) -> None:
+        keys = self.get_session_keys(session_id)
+        ordered_keys = [keys['meta'], keys['recommended']] + [key for name, key in keys.items() if name not in ('meta', 'recommended')]
+        await self.touch_session_script(
+            keys=ordered_keys, args=[SESSION_TTL_SECONDS * 1000, self.get_votes_key_prefix(session_id)], client=client
+        )
+
+    # Records activity in a session and slides the expiry of its keys, returns whether the session exists.
+    async def touch_session(self, session_id: str) -> bool:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            await self._touch_session(session_id, pipe)
+            pipe.zadd(ACTIVITY_KEY, {session_id: time.time()}, xx=True)
+            exists, _ = await pipe.execute()
+        return bool(exists)
+
+    async def track_session(self, session_id: str) -> None:
+        # for sessions created before their activity was recorded
+        await self.redis.zadd(ACTIVITY_KEY, {session_id: time.time()}, nx=True)
+
+    async def get_idle_sessions(self, idle_since: float, limit: int) -> list[str]:
+        return await self.redis.zrangebyscore(ACTIVITY_KEY, '-inf', idle_since, start=0, num=limit)
+
+    async def delete_idle_session(self, session_id: str, idle_since: float) -> bool:
+        if not await self.claim_idle_session_script(keys=[ACTIVITY_KEY], args=[session_id, idle_since]):
+            return False
+        await self._delete_session(session_id)
+        return True
+
+    async def get_memory_statistics(self) -> dict:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.info('memory')
+            pipe.dbsize()
+            pipe.zcard(ACTIVITY_KEY)
+            memory, keys, sessions = await pipe.execute()
+        return {
+            "used_memory": memory.get("used_memory"),
+            "used_memory_peak": memory.get("used_memory_peak"),
+            "keys": keys,
+            "sessions": sessions
+        }
+
+    async def get_excluded_recommendations_sizes(self, session_ids: set[str]) -> list[int]:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for session_id in session_ids:
+                pipe.strlen(self.get_session_keys(session_id)['excluded'])
+            return await pipe.execute()
 
     async def add_song_by_info(self, song_info: dict) -> None:
         query = insert(songs).values(song_info)
         await self.postgres.execute(query)
+        await self.song_cache.invalidate(song_info["id"])
+        await self.refresh_catalog_statistics()
 
-    async def get_song_by_id(self, song_id: str) -> Record:
+    @staticmethod
+    def to_song_row(record: Record) -> dict:
+        row = dict(record)
+        row.pop("search_vector", None)
+        return row
+
+    async def get_song_by_id(self, song_id: str) -> dict:
+        cached = await self.song_cache.get(song_id)
+        if cached is not None:
+            return cached
         query = select(songs).where(songs.c.id == song_id)
         result = await self.postgres.fetch_one(query)
         if result is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Song not found")
-        return result
+        row = self.to_song_row(result)
+        await self.song_cache.set(row)
+        return row
 
-    async def setup_full_text_search(self):
-        schema_setup_queries = [
-            """
-            ALTER TABLE songs ADD COLUMN IF NOT EXISTS search_vector tsvector;
-            """,
+    async def get_songs_by_ids(self, song_ids: list[str]) -> list[dict]:
+        if not song_ids:
+            return []
+        cached = await self.song_cache.get_many(song_ids)
+        missing = [song_id for song_id in song_ids if song_id not in cached]
+        if missing:
+            query = select(songs).where(songs.c.id.in_(missing))
+            rows = [self.to_song_row(record) for record in await self.postgres.fetch_all(query)]
+            await self.song_cache.set_many(rows)
+            cached.update((row["id"], row) for row in rows)
+        return [cached[song_id] for song_id in song_ids if song_id in cached]
+
+    async def refresh_catalog_statistics(self):
+        # Recomputes the statistics after an import and rescales the songs whose normalized tempo changed with them.
+        refresh_queries = [
             """
-            UPDATE songs
-            SET search_vector = to_tsvector('simple', track_name || ' ' || array_to_string(artists, ' '))
-            WHERE search_vector IS NULL;
+            REFRESH MATERIALIZED VIEW catalog_statistics;
             """,
             """
-            CREATE INDEX IF NOT EXISTS idx_songs_search_vector
-            ON songs USING gin(search_vector);
+            WITH scaled AS (
+                SELECT s.id, LEAST(GREATEST((s.tempo - cs.min_tempo) / NULLIF(cs.max_tempo - cs.min_tempo, 0), 0), 1) AS scaled_tempo
+                FROM songs s, catalog_statistics cs
+                WHERE s.tempo IS NOT NULL
+            )
+            UPDATE songs s
+            SET scaled_tempo = scaled.scaled_tempo,
+                features = CASE WHEN s.danceability IS NOT NULL
+                                 AND s.energy IS NOT NULL
+                                 AND s.speechiness IS NOT NULL
+                                 AND s.valence IS NOT NULL
+                    THEN cube(array[s.danceability, s.energy, s.speechiness, s.valence, scaled.scaled_tempo])
+                END
+            FROM scaled
+            WHERE s.id = scaled.id
+              AND s.scaled_tempo IS DISTINCT FROM scaled.scaled_tempo;
             """
         ]
 
-        for query in schema_setup_queries:
+        for query in refresh_queries:
             await self.postgres.execute(query)
+        set_catalog_statistics(await self.get_catalog_statistics())
+        await self.song_cache.clear()  # cached rows carry the old scaled_tempo
+        await self.load_recommendation_engine()  # and so do the features of the in-process engine
+
+    # Catalogs are imported straight into the database, e.g. restored from a dump, so the statistics are compared with
+    # the songs when a replica starts. If they differ, they are refreshed before the replica serves recommendations.
+    async def refresh_catalog_statistics_if_stale(self) -> bool:
+        current = await self.postgres.fetch_one(
+            "SELECT MIN(tempo) AS min_tempo, MAX(tempo) AS max_tempo, COUNT(*) AS song_count FROM songs;"
+        )
+        stored = await self.postgres.fetch_one("SELECT min_tempo, max_tempo, song_count FROM catalog_statistics;")
+        if stored is not None and dict(current) == dict(stored):
+            return False
+        await self.refresh_catalog_statistics()
+        return True
+
+    async def get_catalog_statistics(self) -> CatalogStatistics:
+        result = await self.postgres.fetch_one("SELECT min_tempo, max_tempo, song_count FROM catalog_statistics;")
+        return CatalogStatistics.model_validate(dict(result))
 
-    async def get_songs_by_pattern(self, pattern: str, limit: int) -> list[Record]:
-        ts_query = func.plainto_tsquery('simple', pattern)
-        query = select(songs).where(songs.c.search_vector.op('@@')(ts_query)).limit(limit)
+    async def load_catalog_statistics(self) -> None:
+        set_catalog_statistics(await self.get_catalog_statistics())
+
+    async def get_songs_by_pattern(self, pattern: str, limit: int, after: Optional[tuple[float, str]] = None) -> list[Record]:
+        # every word is matched as a prefix, so "bohem rhaps" already finds "Bohemian Rhapsody"
+        words = re.findall(r"\w+", pattern.lower())
+        if not words:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No matching songs found")
+        ts_query = func.to_tsquery('simple', ' & '.join(f"{word}:*" for word in words))
+        full_text_match = songs.c.search_vector.op('@@')(ts_query)
+        fuzzy_match = literal(pattern.lower()).op('<%')(songs.c.search_text)  # typo tolerance via pg_trgm
+
+        # full text matches are ranked by the track, artist and album weights of the search vector and always
+        # come before fuzzy matches, which are ranked by their trigram word similarity
+        score = cast(case(
+            (full_text_match, 1 + func.ts_rank(songs.c.search_vector, ts_query)),
+            else_=func.word_similarity(pattern.lower(), songs.c.search_text)
+        ), Float).label("score")
+        matches = select(songs, score).where(or_(full_text_match, fuzzy_match)).subquery()
+
+        query = select(matches)
+        if after:  # keyset pagination: continue after the last (score, id) of the previous page
+            after_score, after_id = after
+            query = query.where(or_(
+                matches.c.score < after_score,
+                and_(matches.c.score == after_score, matches.c.id > after_id)
+            ))
+        query = query.order_by(matches.c.score.desc(), matches.c.id).limit(limit)
 
         result = await self.postgres.fetch_all(query)
-        if not result:
+        if not result and not after:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No matching songs found")
         return result
 
@@ -118,81 +583,202 @@ class Repository:
     #     query = delete(songs).where(songs.c.id == song_id)
     #     await self.postgres.execute(query)
 
-    async def get_recommendations_by_songs(self, session_id: str, playlist: list[Song], limit: int = 3) -> list[Record]:
-        if not playlist:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Playlist is empty")
+    async def load_recommendation_engine(self) -> None:
+        if self.recommendation_engine:
+            await self.recommendation_engine.load(self.postgres)
 
-        previously_recommended = self.marked_recommendations[session_id]
+    # The recommendation target of a session is the mean of the features of all songs in its playlist. Instead of
+    # averaging the whole playlist for every round, the session keeps running sums that are updated together with
+    # the playlist, so a round costs the same no matter how long the session has been running.
+    async def get_target_increments(self, song_ids: list[str], sign: int = 1) -> dict[str, float]:
+        # The features are taken from the catalog rows of the songs and never from the songs a client sent, so
+        # removing a song subtracts exactly what adding it added. Only songs with every feature are part of the
+        # target, like songs without a feature cube in the catalog.
+        rows = await self.get_songs_by_ids([song_id for song_id in song_ids if song_id])
+        complete = [row for row in rows if all(row.get(column) is not None for column in FEATURE_COLUMNS)]
+        increments = {column: sign * sum(row[column] for row in complete) for column in FEATURE_COLUMNS}
+        increments['songs'] = sign * len(complete)
+        return increments
 
-        create_extension_query = "CREATE EXTENSION IF NOT EXISTS cube;"
-        await self.postgres.execute(create_extension_query)
+    @staticmethod
+    def add_to_target(pipe: Pipeline, keys: dict[str, str], increments: dict[str, float]) -> None:
+        if increments['songs']:
+            for field, increment in increments.items():
+                pipe.hincrbyfloat(keys['target'], field, increment)
+
+    async def set_recommendation_target(self, session_id: str, playlist: list[Song]) -> dict[str, float]:
+        keys = self.get_session_keys(session_id)
+        sums = await self.get_target_increments([song.id for song in playlist])
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(keys['target'])
+            self.add_to_target(pipe, keys, sums)
+            self.exclude_songs(pipe, keys, await self.get_catalog_indexes(playlist))
+            await pipe.execute()
+        return sums
+
+    async def get_target_sums(self, session_id: str) -> tuple[dict[str, float], bytes]:
+        # the running sums of the target and the bitmap of songs that must not be recommended
+        keys = self.get_session_keys(session_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(keys['target'])
+            pipe.execute_command('GET', keys['excluded'], **{NEVER_DECODE: []})
+            sums, excluded = await pipe.execute()
+        if not sums:
+            # sessions from before the running sums were kept
+            playlist = (await self.get_playlist(session_id)).get_all_songs()
+            sums = await self.set_recommendation_target(session_id, playlist)
+            return sums, await self.get_excluded_recommendations(session_id)
+        return {field: float(value) for field, value in sums.items()}, excluded or b''
+
+    @staticmethod
+    def get_target(sums: dict[str, float]) -> Optional[list[float]]:
+        # None if the playlist is empty, the sums are floats and an empty playlist may leave a rounding error behind
+        if sums.get('songs', 0) < 0.5:
+            return None
+        return [sums[column] / sums['songs'] for column in FEATURE_COLUMNS]
+
+    async def get_recommendation_target(self, session_id: str) -> tuple[Optional[list[float]], bytes]:
+        sums, excluded = await self.get_target_sums(session_id)
+        return self.get_target(sums), excluded
 
-        song_ids = [song.id for song in playlist]
+    async def find_recommendations(self, target: list[float], excluded: bytes, limit: int) -> list[Record | dict]:
+        if self.recommendation_engine:
+            result = self.recommendation_engine.recommend(target, excluded, limit)
+            if not result:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No recommendations found")
+            return result
 
+        # The closest songs to the target are fetched with the KNN operator (<->), which lets Postgres walk the
+        # GiST index instead of sorting the whole catalog.
         query = """
-            WITH tempo_stats AS (
-                SELECT 
-                    MIN(tempo) AS min_tempo,
-                    MAX(tempo) AS max_tempo
+            SELECT
+                s.id,
+                s.catalog_index,
+                ABS(cube_ll_coord(s.features, 1) - cube_ll_coord(t.features, 1)) AS diff_danceability,
+                ABS(cube_ll_coord(s.features, 2) - cube_ll_coord(t.features, 2)) AS diff_energy,
+                ABS(cube_ll_coord(s.features, 3) - cube_ll_coord(t.features, 3)) AS diff_speechiness,
+                ABS(cube_ll_coord(s.features, 4) - cube_ll_coord(t.features, 4)) AS diff_valence,
+                ABS(cube_ll_coord(s.features, 5) - cube_ll_coord(t.features, 5)) AS diff_tempo,
+                s.features <-> t.features AS cosine_distance
+            FROM (SELECT cube(CAST(:target AS float8[])) AS features) t
+            CROSS JOIN LATERAL (
+                SELECT id, catalog_index, features
                 FROM songs
-            ),
-            target_songs AS (
-                SELECT 
-                    AVG(s.danceability) AS avg_danceability, 
-                    AVG(s.energy) AS avg_energy,
-                    AVG(s.speechiness) AS avg_speechiness,
-                    AVG(s.valence) AS avg_valence,
-                    AVG(
-                        LEAST(GREATEST((s.tempo - ts.min_tempo) / (ts.max_tempo - ts.min_tempo), 0), 1)
-                    ) AS avg_tempo  -- normalize tempo
-                FROM songs s, tempo_stats ts
-                WHERE id = ANY(:song_ids)  -- match multiple song IDs
-            ),
-            song_distances AS (
-                -- approximate cosine distance and individual feature differences
-                SELECT 
-                    s.id,
-                    ABS(s.danceability - t.avg_danceability) AS diff_danceability,
-                    ABS(s.energy - t.avg_energy) AS diff_energy,
-                    ABS(s.speechiness - t.avg_speechiness) AS diff_speechiness,
-                    ABS(s.valence - t.avg_valence) AS diff_valence,
-                    ABS(
-                        LEAST(GREATEST((s.tempo - ts.min_tempo) / (ts.max_tempo - ts.min_tempo), 0), 1) - t.avg_tempo
-                    ) AS diff_tempo,
-                    cube_distance(
-                        cube(array[
-                                s.danceability,
-                                s.energy,
-                                s.speechiness,
-                                s.valence,
-                                LEAST(GREATEST((s.tempo - ts.min_tempo) / (ts.max_tempo - ts.min_tempo), 0), 1)
-                        ]),
-                        cube(array[t.avg_danceability, t.avg_energy, t.avg_speechiness, t.avg_valence, t.avg_tempo])
-                    ) AS cosine_distance
-                FROM songs s, target_songs t, tempo_stats ts
-                WHERE s.id != ALL(:song_ids)  -- exclude the target songs
-                  AND s.id != ALL(:previously_recommended)  -- exclude already recommended songs
-            )
-            -- return the 3 closest songs and the feature differences
-            SELECT id, diff_danceability, diff_energy, diff_speechiness, diff_valence, diff_tempo, cosine_distance
-            FROM song_distances
-            ORDER BY cosine_distance
-            LIMIT :limit;
+                -- exclude songs of the playlist and already recommended songs, Redis numbers the bits from the most
+                -- significant bit of a byte
+                WHERE CASE WHEN catalog_index < length(CAST(:excluded AS bytea)) * 8
+                      THEN get_bit(CAST(:excluded AS bytea), catalog_index - catalog_index % 8 + 7 - catalog_index % 8) = 0
+                      ELSE true
+                  END
+                ORDER BY features <-> t.features
+                LIMIT :limit
+            ) s
+            ORDER BY cosine_distance;
         """
 
         params = {
-            "song_ids": song_ids,
-            "previously_recommended": list(previously_recommended),
+            "target": target,
+            "excluded": excluded,
             "limit": limit
         }
 
         result = await self.postgres.fetch_all(query, params)
         if result is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No recommendations found")
+        return result
 
-        new_recommended_ids = {song["id"] for song in result}
-        self.marked_recommendations[session_id].update(new_recommended_ids)
+    async def get_recommendations_by_target(self, session_id: str, limit: int = 3) -> list[Record | dict]:
+        target, excluded = await self.get_recommendation_target(session_id)
+        if target is None:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Playlist is empty")
+        result = await self.find_recommendations(target, excluded, limit)
+        await self.exclude_recommendations(session_id, [song["catalog_index"] for song in result])
         return result
 
+    # The next round of recommendations can be computed while guests still vote, as if a recommendation won. Such a
+    # speculative round is stored together with the target it was computed for and marks nothing as recommended, so
+    # rounds for the songs that lose leave no trace.
+    async def speculate_recommendations(self, session_id: str, round_seq: int, winner: Song, limit: int = 3) -> None:
+        sums, excluded = await self.get_target_sums(session_id)
+        for field, increment in (await self.get_target_increments([winner.id])).items():
+            sums[field] = sums.get(field, 0.0) + increment
+        target = self.get_target(sums)
+        if target is None:
+            return
+        result = await self.find_recommendations(target, excluded, limit)
+        speculation = orjson.dumps({"round": round_seq, "target": target, "result": [dict(row) for row in result]})
+        keys = self.get_session_keys(session_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(keys['speculations'], winner.id, speculation)
+            pipe.expire(keys['speculations'], SESSION_TTL_SECONDS)
+            await pipe.execute()
+
+    async def clear_speculations(self, session_id: str) -> None:
+        await self.redis.delete(self.get_session_keys(session_id)['speculations'])
+
+    # Returns the speculative round for the song that won, unless it was speculated during another round or the
+    # playlist or the recommended songs changed in a way the speculation did not anticipate. All speculations of the
+    # round are dropped either way.
+    async def take_speculated_recommendations(self, session_id: str, winner_id: str) -> Optional[list[dict]]:
+        keys = self.get_session_keys(session_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hget(keys['speculations'], winner_id)
+            pipe.hget(keys['seq'], 'round')
+            pipe.delete(keys['speculations'])
+            speculation, round_seq, _ = await pipe.execute()
+        if not speculation:
+            return None
+        speculation = orjson.loads(speculation)
+        if speculation.get("round") != int(round_seq or 0):
+            return None
+        target, excluded = await self.get_recommendation_target(session_id)
+        if target is None or not all(math.isclose(a, b, abs_tol=1e-9) for a, b in zip(target, speculation["target"])):
+            return None
+        result = speculation["result"]
+        if any(self.is_excluded(excluded, song["catalog_index"]) for song in result):
+            return None
+        await self.exclude_recommendations(session_id, [song["catalog_index"] for song in result])
+        return result
+
+    # The songs recommended in a session and the songs of its playlist are kept as a bitmap over their catalog index,
+    # which stays the same size no matter how many songs have been recommended.
+    async def get_excluded_recommendations(self, session_id: str) -> bytes:
+        # the bitmap is binary, so the reply must not be decoded
+        key = self.get_session_keys(session_id)['excluded']
+        return await self.redis.execute_command('GET', key, **{NEVER_DECODE: []}) or b''
+
+    @staticmethod
+    def is_excluded(excluded: bytes, catalog_index: int) -> bool:
+        # Redis numbers the bits from the most significant bit of a byte
+        byte = catalog_index // 8
+        return byte < len(excluded) and bool(excluded[byte] >> (7 - catalog_index % 8) & 1)
+
+    async def get_catalog_indexes(self, playlist: list[Song]) -> list[int]:
+        # songs that were stored in the session before do not carry their catalog index anymore
+        missing = [song.id for song in playlist if song.catalog_index is None and song.id]
+        rows = await self.get_songs_by_ids(missing) if missing else []
+        catalog_indexes = [song.catalog_index for song in playlist if song.catalog_index is not None]
+        return catalog_indexes + [row["catalog_index"] for row in rows if row.get("catalog_index") is not None]
+
+    @staticmethod
+    def exclude_songs(pipe: Pipeline, keys: dict[str, str], catalog_indexes: list[int]) -> None:
+        for catalog_index in catalog_indexes:
+            pipe.setbit(keys['excluded'], catalog_index, 1)
+
+    async def exclude_recommendations(self, session_id: str, catalog_indexes: list[int]) -> None:
+        keys = self.get_session_keys(session_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            self.exclude_songs(pipe, keys, catalog_indexes)
+            pipe.expire(keys['excluded'], SESSION_TTL_SECONDS)
+            await pipe.execute()
+
+    async def _delete_session(self, session_id: str, client: Optional[Pipeline] = None) -> None:
+        keys = self.get_session_keys(session_id)
+        ordered_keys = [keys['recommended']] + [key for name, key in keys.items() if name != 'recommended']
+        await self.delete_session_script(keys=ordered_keys, args=[self.get_votes_key_prefix(session_id)], client=client)
+
     async def delete_session_by_id(self, session_id: str) -> None:
-        await self.redis.delete(self.get_session_key(session_id))
+        async with self.fenced_pipeline(session_id) as pipe:
+            await self._delete_session(session_id, pipe)
+            await pipe.execute()
+        await self.redis.zrem(ACTIVITY_KEY, session_id)
@@ -1,26 +1,37 @@
+import base64
+import functools
+import inspect
+import json
 import jwt
 import os
 import asyncio
 import uuid
 import math
+import time
+import numpy as np
 import requests
 
 from datetime import timedelta, datetime, timezone
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jwt import InvalidTokenError
-from spotipy import Spotify
-from spotipy.oauth2 import SpotifyOAuth, SpotifyOauthError
-from typing import Annotated
+from typing import Annotated, Iterable, Optional
 from asyncio import Task
-from collections import defaultdict
+from collections import Counter, defaultdict
+from itertools import chain
 
 from models.user import User, SpotifyUser
 from models.token import Token, SpotifyToken
 from models.session import SessionCore, Session
 from models.song import Song, SongList, Playlist
-from models.artifact import Artifact, AverageFeatures
+from models.artifact import Artifact, AverageFeatures, FeatureTrajectory
+from models.delta import (Delta, Snapshot, GuestJoined, GuestLeft, SongQueued, SongRemoved, PlaylistAdvanced,
+                          RecommendationsReplaced, VoteChange, VotesChanged)
+from playlist_scheduler import PlaylistScheduler
 from repository import Repository
+from spotify_client import SpotifyClient
+from session_lock import SessionLease, SessionLocks, SESSION_LOCK_BACKEND
+from vote_coalescer import VoteCoalescer
 from ws.websocket_manager import WebsocketManager
 
 SECRET_KEY = os.getenv("JWT_SECRET_KEY")
@@ -32,45 +43,54 @@ SPOTIFY_REDIRECT_URI = os.getenv("SPOTIFY_REDIRECT_URI")
 DISCOGS_API_URL = os.getenv("DISCOGS_API_URL")
 DISCOGS_API_TOKEN = os.getenv("DISCOGS_API_TOKEN")
 BASE_URL = os.getenv("BASE_URL")
+ARTIFACT_FEATURES = ("danceability", "energy", "speechiness", "valence", "scaled_tempo")
+TRAJECTORY_POINTS = 100
+# time a session may spend per round on computing the next round in advance, 0 turns speculation off
+SPECULATION_BUDGET_SECONDS = float(os.getenv("SPECULATION_BUDGET_SECONDS") or 2)
 
 
 class Service:
     def __init__(self, repository: Repository, websocket_manager: WebsocketManager):
         self.repo = repository
         self.manager = websocket_manager
-        self.spotify_oauth = SpotifyOAuth(
-            client_id=SPOTIFY_CLIENT_ID,
-            client_secret=SPOTIFY_CLIENT_SECRET,
-            redirect_uri=SPOTIFY_REDIRECT_URI,
-            scope="user-library-read"  # scope defines functionalities
-        )
-        self.spotify_api_client = Spotify(auth_manager=self.spotify_oauth)
-        self.session_lock = asyncio.Lock()
+        self.spotify = SpotifyClient(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, SPOTIFY_REDIRECT_URI)
+        lease = SessionLease(repository.redis) if SESSION_LOCK_BACKEND == "redis" else None
+        self.session_locks = SessionLocks(lease)
+        self.vote_coalescer = VoteCoalescer(self.publish_vote_changes)
+        self.scheduler = PlaylistScheduler(repository.redis, self.automate)
         self.asyncio_tasks = defaultdict(list)
+        self.speculation_tasks: dict[str, Task] = {}
 
     @staticmethod
     def with_session_lock(func):
-        async def wrapper(self, *args):
-            async with self.session_lock:
-                return await func(self, *args)
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            session_id = signature.bind(self, *args, **kwargs).arguments["session_id"]
+            async with self.session_locks.hold(session_id):
+                return await func(self, *args, **kwargs)
 
         return wrapper
 
-    def get_spotify_token(self, host: SpotifyUser) -> SpotifyToken:
-        try:
-            spotify_token_info = self.spotify_oauth.get_access_token(host.auth_code, check_cache=False)
-            return SpotifyToken(**spotify_token_info)
-        except SpotifyOauthError:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid authorization code")
+    async def get_spotify_token(self, host: SpotifyUser) -> SpotifyToken:
+        return await self.spotify.get_access_token(host.auth_code)
 
-    @staticmethod
-    def get_display_name(token: SpotifyToken) -> str:
-        try:
-            spotify_host_client = Spotify(auth=token.access_token)
-            user_info = spotify_host_client.current_user()
-            return user_info['display_name']
-        except Exception as e:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Request unsuccessful: {repr(e)}")
+    async def refresh_spotify_token(self, refresh_token: str) -> SpotifyToken:
+        return await self.spotify.refresh_access_token(refresh_token)
+
+    async def get_display_name(self, token: SpotifyToken) -> str:
+        return await self.spotify.get_display_name(token)
+
+    # The display name of a host is kept with the user under its id, so a refresh only asks Spotify for it again if
+    # the user expired in the meantime.
+    async def get_host(self, host_id: str, spotify_token: SpotifyToken) -> User:
+        (host,), _, _ = await self.repo.load_instances([host_id])
+        if host is not None:
+            return User.model_validate_json(host)
+        host = User(id=host_id, username=await self.get_display_name(spotify_token))
+        await self.repo.set_user(host)
+        return host
 
     async def create_user(self, user: User) -> User:
         user.id = str(uuid.uuid4())
@@ -104,24 +124,17 @@ class Service:
         # TODO: Consider also returing the spotify token.
         return user_id
 
-    async def verify_user(self, user_id: str) -> None:
-        await self.repo.verify_user_by_id(user_id)
-
-    async def verify_session(self, session_id: str) -> None:
-        await self.repo.verify_session_by_id(session_id)
-
-    async def verify_instances(self, user_ids: str | list[str] = "", session_id: str = ""):
-        if isinstance(user_ids, str) and user_ids:
-            await self.verify_user(user_ids)
-        elif isinstance(user_ids, list):
-            for user_id in user_ids:
-                await self.verify_user(user_id)
-        if session_id:
-            await self.verify_session(session_id)
-
-    async def get_user(self, user_id: str) -> User:
-        result = await self.repo.get_user_by_id(user_id)
-        return User.model_validate_json(result)
+    # Verifies the users and the session of a request and returns the users by id. Everything is fetched in a
+    # single round trip, the full session as well if requested.
+    async def load_instances(self, user_ids: str | list[str] = "", session_id: str = "",
+                             full_session: bool = False) -> tuple[dict[str, User], Optional[Session]]:
+        user_ids = [user_ids] if isinstance(user_ids, str) and user_ids else list(user_ids)
+        users, session_exists, session = await self.repo.load_instances(user_ids, session_id, full_session)
+        if not all(users):
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authorized! Invalid user ID.")
+        if session_id and not session_exists:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Invalid session ID.")
+        return {user_id: User.model_validate_json(user) for user_id, user in zip(user_ids, users)}, session
 
     # @staticmethod
     # async def get_genre(song: Song) -> None:
@@ -151,22 +164,63 @@ class Service:
     #         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Request unsuccessful: {repr(e)}")
 
     async def get_session(self, session_id: str) -> Session:
-        result = await self.repo.get_session_by_id(session_id)
-        return Session.model_validate_json(result)
+        session = await self.repo.get_session_by_id(session_id)
+        if session is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Invalid session ID.")
+        return session
+
+    async def get_session_core(self, session_id: str) -> SessionCore:
+        session = await self.repo.get_session_core(session_id)
+        if session is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Invalid session ID.")
+        return session
 
+    async def publish_event(self, session_id: str, topic: str, event: Delta) -> None:
+        if not event.seq:
+            event.seq = await self.repo.next_event_seq(session_id, topic)
+            if not event.seq:  # session has ended in the meantime
+                return
+        await self.manager.publish(channel=f"{topic}:{session_id}", message=event)
+
+    # The sequence number is read before the state: every event newer than the snapshot is either not contained in
+    # it yet or, as with the unlocked votes, contained already and idempotent when applied a second time.
     @with_session_lock
-    async def set_most_popular_recommendation(self, session_id: str) -> None:
-        session = await self.get_session(session_id)
-        if not session.playlist.queued_songs:
-            session.playlist.queued_songs.append(max(session.recommendations, key=lambda recommendation: len(recommendation.votes)))
-            await self.repo.set_session(session)
+    async def get_snapshot(self, session_id: str, topic: str) -> Snapshot:
+        seq = await self.repo.get_event_seq(session_id, topic)
+        return Snapshot(seq=seq, data=await self.get_topic_state(session_id, topic))
+
+    # Without the session lock, for the former single topic endpoints: they send the full state on every event, a
+    # state read after the event contains it, and a write in progress is sent with the next event.
+    async def get_topic_state(self, session_id: str, topic: str) -> SessionCore | Playlist | SongList:
+        if topic == "session":
+            return await self.get_session_core(session_id)
+        elif topic == "playlist":
+            return await self.repo.get_playlist(session_id)
+        return SongList(
+            songs=await self.repo.get_recommendations(session_id),
+            voting_start_time=await self.repo.get_voting_start_time(session_id)
+        )
 
-    async def generate_recommendations(self, session: Session, limit: int) -> list[Song]:
-        result = await self.repo.get_recommendations_by_songs(session.id, session.playlist.get_all_songs(), limit)
+    @with_session_lock
+    async def set_most_popular_recommendation(self, session_id: str) -> Optional[str]:
+        # id of the recommendation that was queued, if any
+        recommendations = await self.repo.get_recommendations(session_id)
+        if recommendations:
+            most_popular = max(recommendations, key=lambda recommendation: len(recommendation.votes))
+            if await self.repo.queue_song_if_empty(session_id, most_popular):
+                await self.publish_event(session_id, "playlist", SongQueued(song=most_popular))
+                return most_popular.id
+        return None
+
+    async def generate_recommendations(self, session_id: str, limit: int) -> list[Song]:
+        return await self.to_recommendations(await self.repo.get_recommendations_by_target(session_id, limit))
+
+    async def to_recommendations(self, result: list) -> list[Song]:
+        songs = await self.get_songs_from_database([row['id'] for row in result])
         recommendations = []
         first_recommendation = True
         for row in result:
-            song = await self.get_song_from_database(row['id'])
+            song = songs[row['id']]
             # await self.get_genre(song)
             # await self.get_popularity_and_preview_url(song)
             diffs = {
@@ -184,78 +238,143 @@ class Service:
             recommendations.append(song)
         return recommendations
 
+    # Votes do not take the session lock. The sequence number of a recommendations event is therefore taken before
+    # the recommendations change, so every vote on the new recommendations gets a higher one.
     @with_session_lock
-    async def set_session_recommendations(self, session_id: str, recommendations: list[Song]) -> Session:
-        session = await self.get_session(session_id)
-        session.recommendations.clear()
-        session.recommendations.extend(recommendations)
-        await self.repo.set_session(session)
-        return session
-
-    async def generate_session_recommendations(self, session_id: str, limit: int = 3, automation_task: bool = False) -> None:
-        session = await self.get_session(session_id)
-        start_generation_duration = datetime.now()
-        recommendations = await self.generate_recommendations(session, limit)
-        generation_duration = (datetime.now() - start_generation_duration).total_seconds()
-        if generation_duration < 3:
-            await asyncio.sleep(3)
-        session = await self.set_session_recommendations(session.id, recommendations)
+    async def set_session_recommendations(self, session_id: str, recommendations: list[Song], publish: bool = False) -> int:
+        # seq of the round the recommendations start
+        seq = await self.repo.next_event_seq(session_id, "recommendations") if publish else 0
+        await self.repo.set_recommendations(session_id, recommendations)
+        if publish:
+            await self.publish_event(session_id, "recommendations", RecommendationsReplaced(seq=seq, songs=recommendations))
+        return await self.repo.get_event_seq(session_id, "round")
+
+    async def generate_session_recommendations(self, session_id: str, limit: int = 3, automation_task: bool = False,
+                                               winner_id: str = "") -> None:
+        speculated = await self.repo.take_speculated_recommendations(session_id, winner_id) if winner_id else None
+        if speculated is not None:
+            recommendations = await self.to_recommendations(speculated)  # computed during the vote, no need to wait
+        else:
+            start_generation_duration = datetime.now()
+            recommendations = await self.generate_recommendations(session_id, limit)
+            generation_duration = (datetime.now() - start_generation_duration).total_seconds()
+            if generation_duration < 3:
+                await asyncio.sleep(3)
+        round_seq = await self.set_session_recommendations(session_id, recommendations, publish=not automation_task)
+        if SPECULATION_BUDGET_SECONDS > 0:
+            await self.start_speculation(session_id, round_seq, limit)
         if not automation_task:  # generation was not invoked by automation, remove current asyncio task here
-            await self.manager.publish(
-                channel=f"recommendations:{session.id}",
-                message=SongList(
-                    songs=session.recommendations
-                )
-            )
-            self.asyncio_tasks[session.id].remove(asyncio.current_task())
+            self.asyncio_tasks[session_id].remove(asyncio.current_task())
+
+    # Only the speculation of the latest round runs, so a session never spends more than its budget at a time and
+    # an earlier round cannot write its speculations after the new round cleared them.
+    async def start_speculation(self, session_id: str, round_seq: int, limit: int) -> None:
+        previous = self.speculation_tasks.pop(session_id, None)
+        if previous is not None:
+            previous.cancel()
+            await asyncio.wait({previous})
+        task = asyncio.create_task(self.speculate_next_round(session_id, round_seq, limit))
+        self.speculation_tasks[session_id] = task
+        self.asyncio_tasks[session_id].append(task)
+
+    # While guests vote, the next round is computed for every recommendation as if it won, in the order they are
+    # recommended, until the budget of the session for this round is spent.
+    async def speculate_next_round(self, session_id: str, round_seq: int, limit: int) -> None:
+        try:
+            await self.repo.clear_speculations(session_id)
+            spent_seconds = 0.0
+            for recommendation in await self.repo.get_recommendations(session_id):
+                if spent_seconds >= SPECULATION_BUDGET_SECONDS:
+                    break
+                start = time.perf_counter()
+                try:
+                    await self.repo.speculate_recommendations(session_id, round_seq, recommendation, limit)
+                except HTTPException:
+                    pass  # if this song wins, the round is generated when it is needed
+                spent_seconds += time.perf_counter() - start
+        except Exception as e:
+            print(f"Could not speculate the next round of session {session_id}: {repr(e)}")
+            # the rounds are generated when they are needed instead, like for a song without a speculation
+            try:
+                await self.repo.clear_speculations(session_id)
+            except Exception as e:
+                print(f"Could not clear the speculations of session {session_id}: {repr(e)}")
+        finally:
+            task = asyncio.current_task()
+            if self.speculation_tasks.get(session_id) is task:
+                del self.speculation_tasks[session_id]
+            tasks = self.asyncio_tasks.get(session_id)
+            if tasks is not None and task in tasks:  # gone already if the session was released
+                tasks.remove(task)
 
     @with_session_lock
     async def update_current_song_and_queue(self, session_id: str) -> None:
-        session = await self.get_session(session_id)
-        session.voting_start_time = None
-        if session.playlist.current_song:
-            session.playlist.played_songs.append(session.playlist.current_song)
-            session.playlist.current_song = None
-        session.playlist.current_song = session.playlist.queued_songs.pop(0)
-        await self.repo.set_session(session)
-        await self.manager.publish(channel=f"playlist:{session.id}", message=session.playlist)
+        if await self.repo.advance_queue(session_id):
+            playlist = await self.repo.get_playlist(session_id)
+            await self.publish_event(session_id, "playlist", PlaylistAdvanced(current_song=playlist.current_song))
 
     @with_session_lock
     async def start_voting(self, session_id: str) -> None:
-        session = await self.get_session(session_id)
-        session.voting_start_time = datetime.now().timestamp()
-        await self.repo.set_session(session)
-        await self.manager.publish(
-            channel=f"recommendations:{session.id}",
-            message=SongList(
-                songs=session.recommendations,
-                voting_start_time=session.voting_start_time
-            )
-        )
-
-    async def check_for_empty_queue(self, session_id: str) -> None:
-        session = await self.get_session(session_id)
-        if not session.playlist.queued_songs:
-            await self.generate_session_recommendations(session.id, automation_task=True)
-            await self.start_voting(session.id)
-        self.asyncio_tasks[session.id].remove(asyncio.current_task())
+        voting_start_time = datetime.now(timezone.utc)
+        await self.repo.set_voting_start_time(session_id, voting_start_time)
+        seq = await self.repo.next_event_seq(session_id, "recommendations")
+        await self.publish_event(session_id, "recommendations", RecommendationsReplaced(
+            seq=seq,
+            songs=await self.repo.get_recommendations(session_id),
+            voting_start_time=voting_start_time
+        ))
+
+    async def check_for_empty_queue(self, session_id: str, winner_id: Optional[str] = None) -> None:
+        playlist = await self.repo.get_playlist(session_id)
+        if not playlist.queued_songs:
+            await self.generate_session_recommendations(session_id, automation_task=True, winner_id=winner_id or "")
+            await self.start_voting(session_id)
+        self.asyncio_tasks[session_id].remove(asyncio.current_task())
 
     async def advance_playlist(self, session_id: str) -> Task:
-        await self.set_most_popular_recommendation(session_id)
+        winner_id = await self.set_most_popular_recommendation(session_id)
         await self.update_current_song_and_queue(session_id)
-        generation_task = asyncio.create_task(self.check_for_empty_queue(session_id))
+        generation_task = asyncio.create_task(self.check_for_empty_queue(session_id, winner_id))
         self.asyncio_tasks[session_id].append(generation_task)
         return generation_task
 
-    async def automate(self, session_id: str, generation_task: Task = None):
-        await asyncio.sleep(30)
-        if generation_task:  # failsafe in case generation hasn't finished after 30 seconds
-            await generation_task
+    # Invoked by the scheduler whenever the session is due, on whichever replica claimed it. The generation is
+    # awaited, so the next round never starts before the recommendations of this one are set.
+    async def automate(self, session_id: str) -> bool:
+        if not await self.repo.session_exists(session_id):  # does not count as activity, unlike load_instances
+            return False  # session ended or expired, stop automating it
         generation_task = await self.advance_playlist(session_id)
-        await self.automate(session_id, generation_task)
-
-    async def create_session(self, host_id: str, session: Session) -> Session:
-        host = await self.get_user(host_id)
+        await generation_task
+        return True
+
+    async def resume_automation(self) -> None:
+        # Schedules and tracks sessions that are missing from the schedule or the activity index,
+        # e.g. ones created before they existed.
+        async for key in self.repo.get_all_sessions_by_pattern():
+            session_id = key[len('session:{'):-1]
+            await self.scheduler.schedule(session_id, keep_existing=True)
+            await self.repo.track_session(session_id)
+
+    def get_local_session_ids(self) -> set[str]:
+        return set(self.asyncio_tasks) | self.vote_coalescer.get_session_ids()
+
+    # Frees everything this process keeps for a session that ended or expired.
+    def release_session(self, session_id: str) -> None:
+        for task in self.asyncio_tasks.pop(session_id, []):
+            task.cancel()
+        self.speculation_tasks.pop(session_id, None)
+        self.vote_coalescer.discard(session_id)
+
+    def get_statistics(self) -> dict:
+        return {
+            "sessions_with_tasks": len(self.asyncio_tasks),
+            "tasks": sum(len(tasks) for tasks in self.asyncio_tasks.values()),
+            "session_locks": len(self.session_locks),
+            "sessions_with_pending_votes": len(self.vote_coalescer),
+            "automation_runs": len(self.scheduler)
+        }
+
+    async def create_session(self, host: User, session: Session) -> Session:
         session.id = str(uuid.uuid4())
         session.host_id = str(host.id)
         session.host_name = host.username
@@ -268,80 +387,78 @@ class Service:
         await self.repo.set_session(session)
         await self.advance_playlist(session.id)
         self.asyncio_tasks[session.id].append(asyncio.create_task(self.generate_session_recommendations(session.id)))
-        self.asyncio_tasks[session.id].append(asyncio.create_task(self.automate(session.id)))
+        await self.scheduler.schedule(session.id)
         return await self.get_session(session.id)
 
     @staticmethod
-    def verify_host_of_session(host_id: str, session: Session) -> None:
+    def verify_host_of_session(host_id: str, session: SessionCore) -> None:
         if session.host_id != host_id:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not host of session.")
 
+    @staticmethod
+    def most_frequent(values: Iterable[str]) -> list[str]:
+        # all values with the highest count, in the order they first appear
+        counts = Counter(values)
+        most = max(counts.values(), default=0)
+        return [value for value, count in counts.items() if count == most]
+
+    async def get_usernames(self, session: Session, user_ids: list[str]) -> dict[str, str]:
+        # Most users are still part of the session, the remaining ones are fetched in one round trip.
+        usernames = {guest_id: guest.username for guest_id, guest in session.guests.items()}
+        usernames[session.host_id] = session.host_name
+        missing = [user_id for user_id in user_ids if user_id not in usernames]
+        for user_id, user in zip(missing, await self.repo.get_users_by_ids(missing)):
+            if user:
+                usernames[user_id] = User.model_validate_json(user).username
+        return usernames
+
     async def create_artifact(self, session: Session) -> Artifact:
         played_songs = session.playlist.played_songs
-
-        total_manually_added_songs = 0
-        total_songs_added_per_user = defaultdict(int)
-        total_votes_per_user = defaultdict(int)
-        total_per_significant_feature = defaultdict(int)
-        first_recommendation_wins = 0
-        total_recommended_songs = False
-
-        total_danceability = 0.0
-        total_energy = 0.0
-        total_speechiness = 0.0
-        total_valence = 0.0
-        total_scaled_tempo = 0.0
-
-        for song in played_songs:
-            if song.added_by:
-                total_manually_added_songs += 1
-                total_songs_added_per_user[song.added_by.id] += 1
-            else:
-                total_recommended_songs += 1
-                if song.is_first_recommendation and song.votes:  # TODO: "and song.votes" can be removed if we simply want to count number of top recommendations
-                    first_recommendation_wins += 1
-
-                total_per_significant_feature[song.most_significant_feature] += 1
-
-            total_danceability += song.danceability or 0.0
-            total_energy += song.energy or 0.0
-            total_speechiness += song.speechiness or 0.0
-            total_valence += song.valence or 0.0
-            total_scaled_tempo += song.scaled_tempo or 0.0
-
-            if song.votes:
-                for voter_id in song.votes:
-                    total_votes_per_user[voter_id] += 1
-
         total_songs = len(played_songs)
-        average_features = AverageFeatures(
-            danceability=total_danceability / total_songs if total_songs else 0.0,
-            energy=total_energy / total_songs if total_songs else 0.0,
-            speechiness=total_speechiness / total_songs if total_songs else 0.0,
-            valence=total_valence / total_songs if total_songs else 0.0,
-            scaled_tempo=total_scaled_tempo / total_songs if total_songs else 0.0
-        )
 
-        most_songs_added = max(total_songs_added_per_user.values(), default=-1)
-        user_id_most_songs_added = [user_id for user_id, count in total_songs_added_per_user.items() if count == most_songs_added]  # checks for multiple max counts
-        most_songs_added_by = [await self.get_user(user_id) for user_id in user_id_most_songs_added]
-        most_votes = max(total_votes_per_user.values(), default=-1)
-        user_id_most_votes = [user_id for user_id, count in total_votes_per_user.items() if count == most_votes]  # check for multiple max counts
-        most_votes_by = [await self.get_user(user_id) for user_id in user_id_most_votes]
-        most_significant_feature_overall = max(total_per_significant_feature, key=total_per_significant_feature.get, default=None)
+        # columnar view of the played songs, in the order they were played, missing features count as 0
+        features = np.nan_to_num(np.array(
+            [[getattr(song, feature) for song in played_songs] for feature in ARTIFACT_FEATURES], dtype=np.float64
+        ).reshape(len(ARTIFACT_FEATURES), total_songs))
+        manually_added = np.array([song.added_by is not None for song in played_songs], dtype=bool)
+        first_recommendation_won = np.array(
+            [bool(song.is_first_recommendation and song.votes) for song in played_songs], dtype=bool
+        )
+        recommended = ~manually_added
+        total_recommended_songs = int(recommended.sum())
+        first_recommendation_wins = int((first_recommendation_won & recommended).sum())
+
+        most_songs_added_by_ids = self.most_frequent(song.added_by.id for song in played_songs if song.added_by)
+        most_votes_by_ids = self.most_frequent(chain.from_iterable(song.votes for song in played_songs if song.votes))
+        usernames = await self.get_usernames(session, most_songs_added_by_ids + most_votes_by_ids)
+        most_songs_added_by = [usernames[user_id] for user_id in most_songs_added_by_ids if user_id in usernames]
+        most_votes_by = [usernames[user_id] for user_id in most_votes_by_ids if user_id in usernames]
+        most_significant_feature_overall = next(iter(self.most_frequent(
+            song.most_significant_feature for song in played_songs if not song.added_by
+        )), None)
 
         first_recommendation_vote_percentage = (
             (first_recommendation_wins / total_recommended_songs) * 100 if total_recommended_songs else 0.0
         )
 
+        average_features = features.mean(axis=1) if total_songs else np.zeros(len(ARTIFACT_FEATURES))
+        # Mean features of consecutive songs. Long sessions are condensed to TRAJECTORY_POINTS points per feature.
+        points = min(total_songs, TRAJECTORY_POINTS)
+        starts = np.arange(points) * total_songs // points if points else np.empty(0, dtype=np.intp)
+        trajectory = (
+            np.add.reduceat(features, starts, axis=1) / np.diff(np.append(starts, total_songs))
+            if points else features
+        )
+
         return Artifact(
             songs_played=total_songs,
-            songs_added_manually=total_manually_added_songs,
-            most_songs_added_by=[user.username for user in most_songs_added_by] if most_songs_added_by else None,
-            most_votes_by=[user.username for user in most_votes_by] if most_votes_by else None,
+            songs_added_manually=int(manually_added.sum()),
+            most_songs_added_by=most_songs_added_by or None,
+            most_votes_by=most_votes_by or None,
             most_significant_feature_overall=most_significant_feature_overall,
             first_recommendation_vote_percentage=round(first_recommendation_vote_percentage, 1),
-            average_features=average_features,
+            average_features=AverageFeatures(**dict(zip(ARTIFACT_FEATURES, average_features.tolist()))),
+            feature_trajectory=FeatureTrajectory(**dict(zip(ARTIFACT_FEATURES, trajectory.tolist()))),
             genre_start=played_songs[0].genre if played_songs else None,
             genre_end=played_songs[-1].genre if played_songs else None
         )
@@ -350,40 +467,31 @@ class Service:
     async def end_session(self, host_id: str, session_id: str):
         session = await self.get_session(session_id)
         self.verify_host_of_session(host_id, session)
-        automation_task = self.asyncio_tasks.get(session.id)
-        if automation_task:
-            for task in automation_task:
-                task.cancel()
-        del self.asyncio_tasks[session.id]
+        await self.scheduler.unschedule(session.id)
+        self.release_session(session.id)
         session_artifact = await self.create_artifact(session)
         await self.repo.delete_session_by_id(session.id)
         return session_artifact
 
     @with_session_lock
-    async def add_guest_to_session(self, guest_id: str, session_id: str) -> Session:
-        guest = await self.get_user(guest_id)
-        session = await self.get_session(session_id)
-
-        if guest_id not in session.guests:
-            session.guests[guest_id] = guest
-            await self.repo.set_session(session)
-            await self.manager.publish(channel=f"session:{session_id}", message=SessionCore(**session.model_dump()))
-        return session
+    async def add_guest_to_session(self, guest: User, session_id: str) -> Session:
+        if await self.repo.add_guest(session_id, guest):
+            await self.publish_event(session_id, "session", GuestJoined(guest=guest))
+        return await self.get_session(session_id)
 
     @staticmethod
-    def verify_guest_of_session(guest_id: str, session: Session) -> None:
+    def verify_guest_of_session(guest_id: str, session: SessionCore) -> None:
         if guest_id not in session.guests:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Guest not part of session.")
 
     @with_session_lock
     async def remove_guest_from_session(self, host_id: str, guest_id: str, session_id: str) -> None:
-        session = await self.get_session(session_id)
+        session = await self.get_session_core(session_id)
         if host_id:
             self.verify_host_of_session(host_id, session)
         self.verify_guest_of_session(guest_id, session)
-        del session.guests[guest_id]
-        await self.repo.set_session(session)
-        await self.manager.publish(channel=f"session:{session_id}", message=SessionCore(**session.model_dump()))
+        await self.repo.remove_guest(session_id, guest_id)
+        await self.publish_event(session_id, "session", GuestLeft(guest_id=guest_id))
 
     async def get_song_from_database(self, song_id: str) -> Song:
         result = await self.repo.get_song_by_id(song_id)
@@ -392,6 +500,13 @@ class Service:
         # await self.get_popularity_and_preview_url(song)
         return song
 
+    async def get_songs_from_database(self, song_ids: list[str]) -> dict[str, Song]:
+        result = await self.repo.get_songs_by_ids(song_ids)
+        songs = {row['id']: Song.model_validate(dict(row)) for row in result}
+        if len(songs) != len(set(song_ids)):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Song not found")
+        return songs
+
     # async def add_song_to_database(self, song_id: str) -> Song:
     #     try:
     #         song_info = self.spotify_api_client.track(song_id)
@@ -444,69 +559,64 @@ class Service:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Song not found")
 
     @with_session_lock
-    async def add_song_to_session(self, user_id: str, session_id: str, song_id: str) -> Playlist:
-        user = await self.get_user(user_id)
-        session = await self.get_session(session_id)
-        if user.id not in session.guests and user.id != session.host_id:
+    async def add_song_to_session(self, user: User, session_id: str, song_id: str) -> Playlist:
+        host_id, is_guest = await self.repo.get_session_membership(session_id, user.id)
+        if not is_guest and user.id != host_id:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not part of session")
         song = await self.get_song(song_id)
         song.added_by = user
-        session.playlist.queued_songs.append(song)
-        await self.repo.set_session(session)
-        await self.manager.publish(channel=f"playlist:{session.id}", message=session.playlist)
-        self.asyncio_tasks[session.id].append(asyncio.create_task(self.generate_session_recommendations(session.id)))
-        return session.playlist
+        await self.repo.queue_song(session_id, song)
+        playlist = await self.repo.get_playlist(session_id)
+        await self.publish_event(session_id, "playlist", SongQueued(song=song))
+        self.asyncio_tasks[session_id].append(asyncio.create_task(self.generate_session_recommendations(session_id)))
+        return playlist
 
     @with_session_lock
     async def remove_song_from_session(self, host_id: str, session_id: str, song_id: str) -> None:
-        session = await self.get_session(session_id)
-        self.verify_host_of_session(host_id, session)
-        for idx, song in enumerate(session.playlist.queued_songs):
-            if song.id == song_id:
-                del session.playlist.queued_songs[idx]
-                await self.repo.set_session(session)
-                await self.manager.publish(channel=f"playlist:{session.id}", message=session.playlist)
-                self.asyncio_tasks[session.id].append(asyncio.create_task(self.generate_session_recommendations(session.id)))
-                return
-
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Song not part of playlist")
+        session_host_id, _ = await self.repo.get_session_membership(session_id, host_id)
+        if session_host_id != host_id:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not host of session.")
+        if not await self.repo.remove_queued_song(session_id, song_id):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Song not part of playlist")
+        await self.publish_event(session_id, "playlist", SongRemoved(song_id=song_id))
+        self.asyncio_tasks[session_id].append(asyncio.create_task(self.generate_session_recommendations(session_id)))
 
     async def get_session_recommendations(self, session_id: str) -> SongList:
-        session = await self.get_session(session_id)
-        return SongList(songs=session.recommendations)
+        return SongList(songs=await self.repo.get_recommendations(session_id))
 
-    @with_session_lock
+    # Votes are applied by single atomic scripts in Redis, so they neither need the session lock
+    # nor a read and rewrite of the whole session.
+    # The votes are broadcast by the coalescer, the response does not wait for the broadcast.
     async def add_or_change_vote_to_recommendation(self, guest_id: str, session_id: str, song_id: str) -> SongList:
-        session = await self.get_session(session_id)
-        self.verify_guest_of_session(guest_id, session)
-        curr_rec = next((rec for rec in session.recommendations if rec.id == song_id), None)
-        if not curr_rec:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Song is not recommended.")
-        previous_rec = next((rec for rec in session.recommendations if guest_id in rec.votes), None)  # not None if guest has previously voted
-        if previous_rec:
-            previous_rec.votes.remove(guest_id)
-        if guest_id in curr_rec.votes:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Vote already added.")
-        curr_rec.votes.append(guest_id)
-        await self.repo.set_session(session)
-        response = SongList(songs=session.recommendations)
-        await self.manager.publish(channel=f"recommendations:{session_id}", message=response)
-        return response
+        recommendations = await self.repo.add_or_change_vote(guest_id, session_id, song_id)
+        self.vote_coalescer.add(session_id, VoteChange(guest_id=guest_id, song_id=song_id))
+        return SongList(songs=recommendations)
 
-    @with_session_lock
     async def remove_vote_from_recommendation(self, guest_id: str, session_id: str, song_id: str) -> None:
-        session = await self.get_session(session_id)
-        self.verify_guest_of_session(guest_id, session)
-        curr_rec = next((rec for rec in session.recommendations if rec.id == song_id), None)
-        if not curr_rec:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Song is not recommended.")
-        if guest_id not in curr_rec.votes:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No vote added prior.")
-        curr_rec.votes.remove(guest_id)
-        await self.repo.set_session(session)
-        await self.manager.publish(channel=f"recommendations:{session_id}", message=SongList(songs=session.recommendations))
+        await self.repo.remove_vote(guest_id, session_id, song_id)
+        self.vote_coalescer.add(session_id, VoteChange(guest_id=guest_id))
+
+    async def publish_vote_changes(self, session_id: str, changes: list[VoteChange]) -> None:
+        await self.publish_event(session_id, "recommendations", VotesChanged(changes=changes))
 
-    async def get_matching_songs_from_database(self, pattern: str, limit: int) -> SongList:
-        result = await self.repo.get_songs_by_pattern(pattern, limit)
-        songs = [Song.model_validate(dict(row)) for row in result]
-        return SongList(songs=songs)
+    @staticmethod
+    def encode_search_cursor(score: float, song_id: str) -> str:
+        return base64.urlsafe_b64encode(json.dumps([score, song_id]).encode()).decode()
+
+    @staticmethod
+    def decode_search_cursor(cursor: str) -> tuple[float, str]:
+        try:
+            score, song_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return float(score), str(song_id)
+        except (ValueError, TypeError):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor.")
+
+    async def get_matching_songs_from_database(self, pattern: str, limit: int, cursor: str = None) -> SongList:
+        after = self.decode_search_cursor(cursor) if cursor else None
+        result = await self.repo.get_songs_by_pattern(pattern, limit + 1, after)  # one extra row tells if there is a next page
+        songs = [Song.model_validate(dict(row)) for row in result[:limit]]
+        next_cursor = None
+        if len(result) > limit:
+            last_row = result[limit - 1]
+            next_cursor = self.encode_search_cursor(last_row['score'], last_row['id'])
+        return SongList(songs=songs, next_cursor=next_cursor)
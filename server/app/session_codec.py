@@ -0,0 +1,115 @@
+import orjson
+import os
+
+from typing import Optional
+
+from models.song import Song
+from models.user import User
+
+SESSION_CODEC = os.getenv("SESSION_CODEC") or "compact"
+
+COMPACT_VERSION = 1
+# Catalog metadata of a song in the order of the compact format. Never reorder, append new fields at the end and
+# bump COMPACT_VERSION instead.
+METADATA_FIELDS = (
+    'track_name', 'album', 'album_id', 'artists', 'artist_ids', 'danceability', 'energy', 'speechiness', 'valence',
+    'tempo', 'scaled_tempo', 'duration_ms', 'release_date', 'popularity', 'genre', 'preview_url'
+)
+
+
+class EncodedSongs:
+    def __init__(self) -> None:
+        self.elements: list[str] = []
+        self.metadata: dict[str, str] = {}  # song id to catalog metadata, stored once per session
+        self.users: dict[str, str] = {}  # user id to user, stored once per session
+
+
+# The format songs have been stored in so far: every song is a JSON object that embeds its catalog metadata and the
+# user who added it.
+class JsonSessionCodec:
+    name = "json"
+
+    def encode_song(self, song: Song, include_votes: bool = True, inline_metadata: bool = False) -> str:
+        return song.model_dump_json(exclude=None if include_votes else {'votes'})
+
+    def encode_songs(self, songs: list[Song]) -> EncodedSongs:
+        encoded = EncodedSongs()
+        encoded.elements = [self.encode_song(song) for song in songs]
+        return encoded
+
+
+# Every song is a JSON array that starts with the schema version, followed by the fields that belong to this
+# occurrence of the song in the session:
+#     [version, id, added by user id, most significant feature, similarity score, is first recommendation, votes]
+# The catalog metadata and the user are stored once per session and referenced by id. Elements that live outside
+# the playlist, like recommendations, carry their metadata inline as an eighth item instead.
+class CompactSessionCodec:
+    name = "compact"
+
+    @staticmethod
+    def encode_metadata(song: Song) -> list:
+        return [getattr(song, field) for field in METADATA_FIELDS]
+
+    def encode_song(self, song: Song, include_votes: bool = True, inline_metadata: bool = False) -> str:
+        element = [
+            COMPACT_VERSION,
+            song.id,
+            song.added_by.id if song.added_by else None,
+            song.most_significant_feature,
+            song.similarity_score,
+            song.is_first_recommendation,
+            song.votes if include_votes else []
+        ]
+        if inline_metadata:
+            element.append(self.encode_metadata(song))
+        return orjson.dumps(element).decode()
+
+    def encode_songs(self, songs: list[Song]) -> EncodedSongs:
+        encoded = EncodedSongs()
+        for song in songs:
+            encoded.elements.append(self.encode_song(song))
+            if song.id not in encoded.metadata:
+                encoded.metadata[song.id] = orjson.dumps(self.encode_metadata(song)).decode()
+            if song.added_by and song.added_by.id not in encoded.users:
+                encoded.users[song.added_by.id] = song.added_by.model_dump_json()
+        return encoded
+
+
+SESSION_CODECS = {codec.name: codec for codec in (JsonSessionCodec(), CompactSessionCodec())}
+
+
+def get_session_codec(name: str = SESSION_CODEC) -> JsonSessionCodec | CompactSessionCodec:
+    if name not in SESSION_CODECS:
+        raise ValueError(f"Unknown session codec {name!r}, expected one of {tuple(SESSION_CODECS)}")
+    return SESSION_CODECS[name]
+
+
+class SongDecoder:
+    # Decodes songs of either codec, the format is told apart by the first character. Users are only parsed
+    # once per decoder, no matter how many songs they added.
+    def __init__(self) -> None:
+        self._users: dict[str, User] = {}
+
+    def decode_user(self, data: str) -> User:
+        user = self._users.get(data)
+        if user is None:
+            user = self._users[data] = User.model_validate_json(data)
+        return user
+
+    def decode_song(self, element: str, metadata: Optional[str] = None, user: Optional[str] = None) -> Song:
+        if not element.startswith('['):
+            return Song.model_validate_json(element)
+
+        version, song_id, added_by_id, most_significant_feature, similarity_score, is_first_recommendation, votes, *inline = orjson.loads(element)
+        if version != COMPACT_VERSION:
+            raise ValueError(f"Unknown compact song version {version}")
+        song = dict(zip(METADATA_FIELDS, inline[0] if inline else orjson.loads(metadata or '[]')))
+        song.update(
+            id=song_id,
+            added_by=self.decode_user(user) if added_by_id and user else None,
+            most_significant_feature=most_significant_feature,
+            similarity_score=similarity_score,
+            is_first_recommendation=is_first_recommendation,
+            votes=votes
+        )
+        return Song.model_validate(song)
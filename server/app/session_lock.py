@@ -0,0 +1,137 @@
+import asyncio
+import os
+import time
+import uuid
+
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from fastapi import HTTPException, status
+from redis.asyncio import Redis
+from typing import AsyncIterator, Optional
+from weakref import WeakValueDictionary
+
+from metrics import SESSION_LOCK_WAIT, SESSION_LOCK_HOLD
+
+SESSION_LOCK_BACKEND = os.getenv("SESSION_LOCK_BACKEND") or "local"
+SESSION_LEASE_SECONDS = float(os.getenv("SESSION_LEASE_SECONDS") or 10)
+SESSION_LEASE_WAIT_SECONDS = float(os.getenv("SESSION_LEASE_WAIT_SECONDS") or 30)
+FENCE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# Fencing token of the lease held by the current task, None without a lease. Repository writes only go through while
+# it is still the latest token of the session, see Repository.fenced_pipeline. Tasks started under the lock inherit
+# it, so they have to take the lock themselves before they write.
+fencing_token: ContextVar[Optional[int]] = ContextVar("fencing_token", default=None)
+
+# KEYS: lease, fence
+# ARGV: owner, lease in milliseconds, fence expiry in seconds
+ACQUIRE_LEASE = """
+if not redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 0
+end
+local fence = redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return fence
+"""
+
+# KEYS: lease
+# ARGV: owner, lease in milliseconds
+RENEW_LEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS: lease
+# ARGV: owner
+RELEASE_LEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class SessionLease:
+    def __init__(self, redis: Redis, lease_seconds: float = SESSION_LEASE_SECONDS,
+                 wait_seconds: float = SESSION_LEASE_WAIT_SECONDS) -> None:
+        self._lease_ms = int(lease_seconds * 1000)
+        self._wait_seconds = wait_seconds
+        self._acquire = redis.register_script(ACQUIRE_LEASE)
+        self._renew = redis.register_script(RENEW_LEASE)
+        self._release = redis.register_script(RELEASE_LEASE)
+
+    @staticmethod
+    def get_lease_keys(session_id: str) -> list[str]:
+        return [f'session:{{{session_id}}}:lease', f'session:{{{session_id}}}:fence']
+
+    async def _keep_alive(self, lease_key: str, owner: str) -> None:
+        while True:
+            await asyncio.sleep(self._lease_ms / 3000)
+            await self._renew(keys=[lease_key], args=[owner, self._lease_ms])
+
+    @asynccontextmanager
+    async def hold(self, session_id: str) -> AsyncIterator[int]:
+        lease_key, fence_key = self.get_lease_keys(session_id)
+        owner = str(uuid.uuid4())
+        deadline = asyncio.get_running_loop().time() + self._wait_seconds
+        backoff = 0.005
+        while not (token := await self._acquire(keys=[lease_key, fence_key], args=[owner, self._lease_ms, FENCE_TTL_SECONDS])):
+            if asyncio.get_running_loop().time() > deadline:
+                raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Session is busy, try again.")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 0.2)
+
+        keep_alive = asyncio.create_task(self._keep_alive(lease_key, owner))
+        try:
+            # The fencing token increases with every acquisition of the lease and the fence key always holds the
+            # latest one, so writes of a holder whose lease already expired and was taken over can be rejected.
+            yield token
+        finally:
+            keep_alive.cancel()
+            await self._release(keys=[lease_key], args=[owner])
+
+
+# One lock per session instead of one for the whole process: operations on unrelated sessions no longer wait for
+# each other. Locks are created on demand and disappear with the last coroutine holding or waiting for them.
+class SessionLocks:
+    def __init__(self, lease: Optional[SessionLease] = None) -> None:
+        self._locks: WeakValueDictionary[str, asyncio.Lock] = WeakValueDictionary()
+        self._lease = lease
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    def get_lock(self, session_id: str) -> asyncio.Lock:
+        lock = self._locks.get(session_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[session_id] = lock
+        return lock
+
+    @asynccontextmanager
+    async def hold(self, session_id: str) -> AsyncIterator[Optional[int]]:
+        lock = self.get_lock(session_id)
+        start = time.perf_counter()
+        async with lock:
+            if self._lease is None:
+                async with self._observe(start):
+                    yield None
+            else:
+                async with self._lease.hold(session_id) as token:
+                    context_token = fencing_token.set(token)
+                    try:
+                        async with self._observe(start):
+                            yield token
+                    finally:
+                        fencing_token.reset(context_token)
+
+    @staticmethod
+    @asynccontextmanager
+    async def _observe(start: float) -> AsyncIterator[None]:
+        acquired = time.perf_counter()
+        SESSION_LOCK_WAIT.observe(acquired - start)
+        try:
+            yield
+        finally:
+            SESSION_LOCK_HOLD.observe(time.perf_counter() - acquired)
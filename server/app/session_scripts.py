@@ -0,0 +1,248 @@
+# Lua scripts operating on the granular session structures in Redis. All keys of a session share the {session_id}
+# hash tag, so the votes keys that are derived from ARGV inside the scripts live in the same cluster slot.
+
+# Songs are either JSON objects (json codec) or JSON arrays starting with the schema version (compact codec),
+# see session_codec.py.
+SONG_ID = """
+local function song_id(song)
+    local decoded = cjson.decode(song)
+    if decoded['id'] then
+        return decoded['id']
+    end
+    return decoded[2]
+end
+"""
+
+RECOMMENDATIONS_WITH_VOTES = SONG_ID + """
+local function recommendations_with_votes(recommendations_key, votes_prefix)
+    local result = {}
+    for _, song in ipairs(redis.call('LRANGE', recommendations_key, 0, -1)) do
+        table.insert(result, song)
+        table.insert(result, redis.call('SMEMBERS', votes_prefix .. song_id(song)))
+    end
+    return result
+end
+"""
+
+# The recommendation target of a session is a hash of running sums of the song features and the number of songs
+# they were summed over. Scripts that change the playlist update it with the increments from ARGV, starting at an index.
+ADD_TO_TARGET = """
+local function add_to_target(target_key, first)
+    for i = first, #ARGV, 2 do
+        redis.call('HINCRBYFLOAT', target_key, ARGV[i], ARGV[i + 1])
+    end
+end
+"""
+
+# Compact playlist songs reference the catalog metadata and the user who added them. Every song is returned
+# together with both, as empty strings if the song does not reference them.
+SONGS_WITH_REFERENCES = """
+local function songs_with_references(songs, metadata_key, users_key)
+    local result = {}
+    for _, song in ipairs(songs) do
+        local metadata, user = '', ''
+        if string.sub(song, 1, 1) == '[' then
+            local decoded = cjson.decode(song)
+            if decoded[8] == nil then
+                metadata = redis.call('HGET', metadata_key, decoded[2]) or ''
+            end
+            if decoded[3] ~= cjson.null then
+                user = redis.call('HGET', users_key, decoded[3]) or ''
+            end
+        end
+        table.insert(result, song)
+        table.insert(result, metadata)
+        table.insert(result, user)
+    end
+    return result
+end
+"""
+
+# KEYS: meta, guests, played, current, queue, recommendations, songs, users
+# ARGV: votes key prefix
+LOAD_SESSION = RECOMMENDATIONS_WITH_VOTES + SONGS_WITH_REFERENCES + """
+local meta = redis.call('HGETALL', KEYS[1])
+if #meta == 0 then
+    return {}
+end
+local current = redis.call('GET', KEYS[4])
+return {
+    meta,
+    redis.call('HGETALL', KEYS[2]),
+    songs_with_references(redis.call('LRANGE', KEYS[3], 0, -1), KEYS[7], KEYS[8]),
+    songs_with_references(current and {current} or {}, KEYS[7], KEYS[8]),
+    songs_with_references(redis.call('LRANGE', KEYS[5], 0, -1), KEYS[7], KEYS[8]),
+    recommendations_with_votes(KEYS[6], ARGV[1])
+}
+"""
+
+# KEYS: played, current, queue, songs, users
+LOAD_PLAYLIST = SONGS_WITH_REFERENCES + """
+local current = redis.call('GET', KEYS[2])
+return {
+    songs_with_references(redis.call('LRANGE', KEYS[1], 0, -1), KEYS[4], KEYS[5]),
+    songs_with_references(current and {current} or {}, KEYS[4], KEYS[5]),
+    songs_with_references(redis.call('LRANGE', KEYS[3], 0, -1), KEYS[4], KEYS[5])
+}
+"""
+
+# KEYS: recommendations
+# ARGV: votes key prefix
+LOAD_RECOMMENDATIONS = RECOMMENDATIONS_WITH_VOTES + """
+return recommendations_with_votes(KEYS[1], ARGV[1])
+"""
+
+# Status codes shared by the vote scripts.
+VOTE_OK = 1
+VOTE_SESSION_NOT_FOUND = -1
+VOTE_NOT_A_GUEST = -2
+VOTE_NOT_RECOMMENDED = -3
+VOTE_NOT_FOUND = -4
+
+# KEYS: meta, guests, recommended, voters, recommendations
+# ARGV: guest id, song id, votes key prefix
+# A repeated vote leaves the votes as they are and is answered with them, like a changed one.
+ADD_OR_CHANGE_VOTE = RECOMMENDATIONS_WITH_VOTES + """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {-1}
+end
+if redis.call('HEXISTS', KEYS[2], ARGV[1]) == 0 then
+    return {-2}
+end
+if redis.call('SISMEMBER', KEYS[3], ARGV[2]) == 0 then
+    return {-3}
+end
+local previous = redis.call('HGET', KEYS[4], ARGV[1])
+if previous then
+    redis.call('SREM', ARGV[3] .. previous, ARGV[1])
+end
+redis.call('SADD', ARGV[3] .. ARGV[2], ARGV[1])
+redis.call('HSET', KEYS[4], ARGV[1], ARGV[2])
+return {1, recommendations_with_votes(KEYS[5], ARGV[3])}
+"""
+
+# KEYS: meta, guests, recommended, voters, recommendations
+# ARGV: guest id, song id, votes key prefix
+REMOVE_VOTE = RECOMMENDATIONS_WITH_VOTES + """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {-1}
+end
+if redis.call('HEXISTS', KEYS[2], ARGV[1]) == 0 then
+    return {-2}
+end
+if redis.call('SISMEMBER', KEYS[3], ARGV[2]) == 0 then
+    return {-3}
+end
+if redis.call('SREM', ARGV[3] .. ARGV[2], ARGV[1]) == 0 then
+    return {-4}
+end
+redis.call('HDEL', KEYS[4], ARGV[1])
+return {1, recommendations_with_votes(KEYS[5], ARGV[3])}
+"""
+
+# KEYS: meta, seq
+# ARGV: topic
+NEXT_EVENT_SEQ = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+return redis.call('HINCRBY', KEYS[2], ARGV[1], 1)
+"""
+
+# Every replacement starts a new round of recommendations, which is numbered in the seq hash.
+# KEYS: recommendations, recommended, voters, seq
+# ARGV: votes key prefix, then song id and serialized song for every new recommendation
+REPLACE_RECOMMENDATIONS = """
+for _, song_id in ipairs(redis.call('SMEMBERS', KEYS[2])) do
+    redis.call('DEL', ARGV[1] .. song_id)
+end
+redis.call('DEL', KEYS[1], KEYS[2], KEYS[3])
+for i = 2, #ARGV, 2 do
+    redis.call('SADD', KEYS[2], ARGV[i])
+    redis.call('RPUSH', KEYS[1], ARGV[i + 1])
+end
+return redis.call('HINCRBY', KEYS[4], 'round', 1)
+"""
+
+# KEYS: meta, played, current, queue
+ADVANCE_QUEUE = """
+local next_song = redis.call('LPOP', KEYS[4])
+if not next_song then
+    return 0
+end
+redis.call('HDEL', KEYS[1], 'voting_start_time')
+local current = redis.call('GET', KEYS[3])
+if current then
+    redis.call('RPUSH', KEYS[2], current)
+end
+redis.call('SET', KEYS[3], next_song)
+return 1
+"""
+
+# KEYS: queue, songs, users, target
+# ARGV: serialized song, song id, metadata, user id, user (metadata and user empty if the song does not reference them),
+#       then field and increment of the recommendation target for every feature sum
+QUEUE_IF_EMPTY = ADD_TO_TARGET + """
+if redis.call('LLEN', KEYS[1]) > 0 then
+    return 0
+end
+if ARGV[3] ~= '' then
+    redis.call('HSET', KEYS[2], ARGV[2], ARGV[3])
+end
+if ARGV[5] ~= '' then
+    redis.call('HSET', KEYS[3], ARGV[4], ARGV[5])
+end
+redis.call('RPUSH', KEYS[1], ARGV[1])
+add_to_target(KEYS[4], 6)
+return 1
+"""
+
+# KEYS: queue, target
+# ARGV: song id, then field and increment of the recommendation target for every feature sum
+REMOVE_QUEUED_SONG = SONG_ID + ADD_TO_TARGET + """
+for _, song in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+    if song_id(song) == ARGV[1] then
+        redis.call('LREM', KEYS[1], 1, song)
+        add_to_target(KEYS[2], 2)
+        return 1
+    end
+end
+return 0
+"""
+
+# KEYS: every fixed session key, the recommended set first
+# ARGV: votes key prefix
+DELETE_SESSION = """
+for _, song_id in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    redis.call('DEL', ARGV[1] .. song_id)
+end
+return redis.call('DEL', unpack(KEYS))
+"""
+
+# Slides the expiry of every key of a session. Returns 0 if the session does not exist.
+# KEYS: meta, recommended, every other fixed session key
+# ARGV: expiry in milliseconds, votes key prefix
+TOUCH_SESSION = """
+if redis.call('PEXPIRE', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+for i = 2, #KEYS do
+    redis.call('PEXPIRE', KEYS[i], ARGV[1])
+end
+for _, song_id in ipairs(redis.call('SMEMBERS', KEYS[2])) do
+    redis.call('PEXPIRE', ARGV[2] .. song_id, ARGV[1])
+end
+return 1
+"""
+
+# Removes a session from the activity index if it has not been active since the cutoff. Only the replica that
+# removes it goes on to delete the session.
+# KEYS: activity
+# ARGV: session id, cutoff
+CLAIM_IDLE_SESSION = """
+local last_active = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if last_active and tonumber(last_active) <= tonumber(ARGV[2]) then
+    return redis.call('ZREM', KEYS[1], ARGV[1])
+end
+return 0
+"""
@@ -0,0 +1,68 @@
+import asyncio
+import os
+import time
+
+from typing import Awaitable, Callable
+
+from repository import Repository, SESSION_TTL_SECONDS
+
+SESSION_SWEEP_SECONDS = float(os.getenv("SESSION_SWEEP_SECONDS") or 60)
+SWEEP_BATCH_SIZE = 100
+
+
+# Sessions that are never ended through the API would otherwise stay in Redis and in the maps of every replica
+# forever. Each replica periodically
+#   - records activity for the sessions it holds websockets for, listening clients keep a party alive,
+#   - deletes sessions without activity for the session TTL, together with keys that were created without expiry,
+#   - frees its in-process state of sessions that no longer exist, no matter which replica ended them.
+class SessionSweeper:
+    def __init__(self, repository: Repository, release: Callable[[str], Awaitable[None]],
+                 local_sessions: Callable[[], set[str]], connected_sessions: Callable[[], set[str]],
+                 interval_seconds: float = SESSION_SWEEP_SECONDS, idle_seconds: float = SESSION_TTL_SECONDS) -> None:
+        self._repo = repository
+        self._release = release
+        self._local_sessions = local_sessions
+        self._connected_sessions = connected_sessions
+        self._interval_seconds = interval_seconds
+        self._idle_seconds = idle_seconds
+        self._task: asyncio.Task | None = None
+        self.deleted_sessions = 0
+        self.released_sessions = 0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval_seconds)
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"Could not sweep sessions: {repr(e)}")
+
+    async def sweep(self) -> None:
+        connected = self._connected_sessions()
+        for session_id in connected:
+            await self._repo.touch_session(session_id)
+
+        idle_since = time.time() - self._idle_seconds
+        while idle_sessions := await self._repo.get_idle_sessions(idle_since, SWEEP_BATCH_SIZE):
+            for session_id in idle_sessions:
+                if await self._repo.delete_idle_session(session_id, idle_since):
+                    self.deleted_sessions += 1
+            if len(idle_sessions) < SWEEP_BATCH_SIZE:
+                break
+
+        local = list(self._local_sessions() | connected)
+        existing = await self._repo.get_existing_sessions(local) if local else set()
+        for session_id in local:
+            if session_id not in existing:
+                await self._release(session_id)
+                self.released_sessions += 1
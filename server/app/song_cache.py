@@ -0,0 +1,144 @@
+import os
+import orjson
+import time
+
+from collections import OrderedDict
+from redis.asyncio import Redis
+from typing import Optional
+
+SONG_CACHE_MAX_BYTES = int(os.getenv("SONG_CACHE_MAX_BYTES") or 16 * 1024 * 1024)
+SONG_CACHE_TTL_SECONDS = int(os.getenv("SONG_CACHE_TTL_SECONDS") or 24 * 60 * 60)
+SONG_CACHE_GENERATION_CHECK_SECONDS = float(os.getenv("SONG_CACHE_GENERATION_CHECK_SECONDS") or 1)
+# outside of the song:* keys, so clearing the shared tier does not remove it
+GENERATION_KEY = 'songs:generation'
+
+
+class CacheStatistics:
+    def __init__(self) -> None:
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def as_dict(self) -> dict[str, int]:
+        return {
+            "local_hits": self.local_hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+# Catalog rows barely ever change, so they are kept in a bounded in-process LRU in front of a Redis tier
+# that is shared by all replicas. Only a miss in both tiers reaches Postgres.
+# Clearing the cache bumps a generation in Redis. Every replica drops its local entries once it sees a new generation,
+# which it checks at most every SONG_CACHE_GENERATION_CHECK_SECONDS.
+class SongCache:
+    def __init__(self, redis: Redis, max_bytes: int = SONG_CACHE_MAX_BYTES, ttl_seconds: int = SONG_CACHE_TTL_SECONDS,
+                 generation_check_seconds: float = SONG_CACHE_GENERATION_CHECK_SECONDS) -> None:
+        self._redis = redis
+        self._entries: OrderedDict[str, tuple[dict, int]] = OrderedDict()
+        self._max_bytes = max_bytes
+        self._ttl_seconds = ttl_seconds
+        self._generation: Optional[int] = None
+        self._generation_check_seconds = generation_check_seconds
+        self._generation_checked_at = float('-inf')
+        self.size_bytes = 0
+        self.statistics = CacheStatistics()
+
+    @staticmethod
+    def get_song_key(song_id: str) -> str:
+        return f'song:{song_id}'
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _get_local(self, song_id: str) -> Optional[dict]:
+        entry = self._entries.get(song_id)
+        if entry is None:
+            return None
+        self._entries.move_to_end(song_id)
+        return entry[0]
+
+    def _set_local(self, song_id: str, row: dict, size: int) -> None:
+        if size > self._max_bytes:
+            return
+        self._discard_local(song_id)
+        self._entries[song_id] = (row, size)
+        self.size_bytes += size
+        while self.size_bytes > self._max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.size_bytes -= evicted_size
+            self.statistics.evictions += 1
+
+    def _discard_local(self, song_id: str) -> None:
+        entry = self._entries.pop(song_id, None)
+        if entry is not None:
+            self.size_bytes -= entry[1]
+
+    def _clear_local(self, generation: int) -> None:
+        self._entries.clear()
+        self.size_bytes = 0
+        self._generation = generation
+        self._generation_checked_at = time.monotonic()
+
+    async def _check_generation(self) -> None:
+        if time.monotonic() - self._generation_checked_at < self._generation_check_seconds:
+            return
+        generation = int(await self._redis.get(GENERATION_KEY) or 0)
+        if generation != self._generation:
+            self._clear_local(generation)
+        self._generation_checked_at = time.monotonic()
+
+    def get_statistics(self) -> dict[str, int]:
+        return {**self.statistics.as_dict(), "entries": len(self._entries), "size_bytes": self.size_bytes}
+
+    async def get(self, song_id: str) -> Optional[dict]:
+        return (await self.get_many([song_id])).get(song_id)
+
+    async def get_many(self, song_ids: list[str]) -> dict[str, dict]:
+        await self._check_generation()
+        found = {}
+        missing = []
+        for song_id in dict.fromkeys(song_ids):
+            row = self._get_local(song_id)
+            if row is None:
+                missing.append(song_id)
+            else:
+                found[song_id] = row
+        self.statistics.local_hits += len(found)
+
+        if missing:
+            serialized_rows = await self._redis.mget([self.get_song_key(song_id) for song_id in missing])
+            for song_id, serialized_row in zip(missing, serialized_rows):
+                if serialized_row is None:
+                    self.statistics.misses += 1
+                    continue
+                row = orjson.loads(serialized_row)
+                self._set_local(song_id, row, len(serialized_row))
+                found[song_id] = row
+                self.statistics.shared_hits += 1
+        return found
+
+    async def set_many(self, rows: list[dict]) -> None:
+        if not rows:
+            return
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for row in rows:
+                serialized_row = orjson.dumps(row)
+                self._set_local(row["id"], orjson.loads(serialized_row), len(serialized_row))
+                pipe.set(self.get_song_key(row["id"]), serialized_row, ex=self._ttl_seconds)
+            await pipe.execute()
+
+    async def set(self, row: dict) -> None:
+        await self.set_many([row])
+
+    async def invalidate(self, song_id: str) -> None:
+        self._discard_local(song_id)
+        await self._redis.delete(self.get_song_key(song_id))
+
+    async def clear(self) -> None:
+        self._clear_local(await self._redis.incr(GENERATION_KEY))
+        keys = [key async for key in self._redis.scan_iter(match=self.get_song_key('*'))]
+        if keys:
+            await self._redis.unlink(*keys)
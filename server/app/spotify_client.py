@@ -0,0 +1,75 @@
+import httpx
+import os
+
+from fastapi import HTTPException, status
+
+from models.token import SpotifyToken
+
+# The base URLs can point to a local stand-in of the Spotify accounts service and Web API, e.g. for tests.
+SPOTIFY_ACCOUNTS_URL = os.getenv("SPOTIFY_ACCOUNTS_URL") or "https://accounts.spotify.com"
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL") or "https://api.spotify.com/v1"
+SPOTIFY_TIMEOUT_SECONDS = float(os.getenv("SPOTIFY_TIMEOUT_SECONDS") or 5)
+SPOTIFY_MAX_CONNECTIONS = int(os.getenv("SPOTIFY_MAX_CONNECTIONS") or 20)
+
+
+# Talks to Spotify without blocking the event loop. All requests share one connection pool, so logins of hosts
+# reuse connections instead of opening a new TLS connection each time.
+class SpotifyClient:
+    def __init__(self, client_id: str, client_secret: str, redirect_uri: str,
+                 accounts_url: str = SPOTIFY_ACCOUNTS_URL, api_url: str = SPOTIFY_API_URL,
+                 timeout_seconds: float = SPOTIFY_TIMEOUT_SECONDS, max_connections: int = SPOTIFY_MAX_CONNECTIONS,
+                 transport: httpx.AsyncBaseTransport = None) -> None:
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._redirect_uri = redirect_uri
+        self._accounts_url = accounts_url.rstrip('/')
+        self._api_url = api_url.rstrip('/')
+        self._http = httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout_seconds),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            transport=transport
+        )
+
+    async def close(self) -> None:
+        await self._http.aclose()
+
+    async def _request_token(self, data: dict) -> dict:
+        try:
+            response = await self._http.post(
+                f'{self._accounts_url}/api/token',
+                data=data,
+                auth=(self._client_id or '', self._client_secret or '')
+            )
+        except httpx.HTTPError as e:
+            raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Spotify unavailable: {repr(e)}")
+        if response.status_code in (status.HTTP_400_BAD_REQUEST, status.HTTP_401_UNAUTHORIZED):
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid authorization code")
+        if response.is_error:
+            raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Spotify responded with {response.status_code}")
+        return response.json()
+
+    async def get_access_token(self, auth_code: str) -> SpotifyToken:
+        token_info = await self._request_token({
+            'grant_type': 'authorization_code',
+            'code': auth_code,
+            'redirect_uri': self._redirect_uri
+        })
+        return SpotifyToken.model_validate(token_info)
+
+    async def refresh_access_token(self, refresh_token: str) -> SpotifyToken:
+        token_info = await self._request_token({'grant_type': 'refresh_token', 'refresh_token': refresh_token})
+        token_info.setdefault('refresh_token', refresh_token)  # Spotify only sometimes rotates the refresh token
+        return SpotifyToken.model_validate(token_info)
+
+    async def get_display_name(self, token: SpotifyToken) -> str:
+        try:
+            response = await self._http.get(
+                f'{self._api_url}/me',
+                headers={'Authorization': f'Bearer {token.access_token}'}
+            )
+            response.raise_for_status()
+            user_info = response.json()
+            display_name = user_info.get('display_name') or user_info['id']  # not every Spotify user has a display name
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Request unsuccessful: {repr(e)}")
+        return display_name
@@ -0,0 +1,48 @@
+import asyncio
+import os
+
+from typing import Awaitable, Callable
+
+from models.delta import VoteChange
+
+VOTE_COALESCE_WINDOW_MS = int(os.getenv("VOTE_COALESCE_WINDOW_MS") or 100)
+
+
+# Votes arrive in bursts at the start of every round. Instead of one broadcast per vote, the changes of a session
+# are collected for a short window and broadcast together, at most once per window and session. Only the latest
+# change of every guest is kept, which is all a client needs to get to the current votes.
+class VoteCoalescer:
+    def __init__(self, flush: Callable[[str, list[VoteChange]], Awaitable[None]],
+                 window_seconds: float = VOTE_COALESCE_WINDOW_MS / 1000) -> None:
+        self._flush = flush
+        self._window_seconds = window_seconds
+        self._pending: dict[str, dict[str, VoteChange]] = {}
+        self._tasks: dict[str, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def get_session_ids(self) -> set[str]:
+        return set(self._pending)
+
+    def add(self, session_id: str, change: VoteChange) -> None:
+        pending = self._pending.setdefault(session_id, {})
+        pending.pop(change.guest_id, None)  # keeps the guests ordered by their latest change
+        pending[change.guest_id] = change
+        if session_id not in self._tasks:
+            self._tasks[session_id] = asyncio.create_task(self._flush_later(session_id))
+
+    def discard(self, session_id: str) -> None:
+        task = self._tasks.pop(session_id, None)
+        if task is not None:
+            task.cancel()
+        self._pending.pop(session_id, None)
+
+    async def _flush_later(self, session_id: str) -> None:
+        await asyncio.sleep(self._window_seconds)
+        del self._tasks[session_id]
+        changes = list(self._pending.pop(session_id, {}).values())
+        try:
+            await self._flush(session_id, changes)
+        except Exception as e:
+            print(f"Could not broadcast votes of session {session_id}: {repr(e)}")
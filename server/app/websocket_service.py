@@ -1,40 +1,157 @@
-from fastapi import WebSocket, WebSocketDisconnect
+import asyncio
+import json
+import time
 
+from fastapi import HTTPException, WebSocket, WebSocketDisconnect, status
+from pydantic import BaseModel
+from typing import Awaitable, Callable
+
+from metrics import FANOUT_LAG
+from models.delta import Snapshot
 from repository import Repository
-from ws.websocket_manager import WebsocketManager
+from ws.event import Event, Resync
+from ws.websocket_manager import WebsocketManager, Subscriber, SlowConsumer
+
+TOPICS = ("session", "playlist", "recommendations")
 
 
 class WebSocketService:
-    def __init__(self, repository: Repository, websocket_manager: WebsocketManager):
+    def __init__(self, repository: Repository, websocket_manager: WebsocketManager,
+                 snapshot_provider: Callable[[str, str], Awaitable[Snapshot]],
+                 state_provider: Callable[[str, str], Awaitable[BaseModel]]):
         self._repository = repository
         self._manager = websocket_manager
+        self._snapshot_provider = snapshot_provider
+        self._state_provider = state_provider
         self._active_connections: dict[str, set[WebSocket]] = {}
+        # channel -> the last event and the full state read for it, shared by the untagged connections of the channel
+        self._legacy_states: dict[str, tuple[Event, asyncio.Future[str]]] = {}
+
+    @staticmethod
+    def parse_topics(topics: str) -> list[str]:
+        requested = list(dict.fromkeys(topic for topic in topics.split(",") if topic))
+        if not requested or not set(requested) <= set(TOPICS):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Unknown topic.")
+        return requested
 
-    async def connect(self, websocket: WebSocket, session_id: str, ws_type: str) -> None:
+    # One connection serves any number of topics of a session. Tagged frames wrap every event as
+    # {"topic": ..., "event": ...}. Untagged connections are the former single topic endpoints, whose clients expect
+    # the full state of the topic (SessionCore, Playlist or SongList) on every change instead of the events.
+    async def connect(self, websocket: WebSocket, session_id: str, topics: list[str], tagged: bool = True) -> None:
         if session_id not in self._active_connections:
             self._active_connections[session_id] = set()
         self._active_connections[session_id].add(websocket)
 
-        async with self._manager.subscribe(channel=f"{ws_type}:{session_id}") as subscriber:
-            try:
-                async for event in subscriber:
-                    # We technically send a json, but it is in string format. Using "send_json" would
-                    # result in redundant serialization as it was done so before publishing to redis.
-                    await websocket.send_text(event.message)
-            except WebSocketDisconnect:
-                #TODO: remove user from session?
-                self._active_connections[session_id].remove(websocket)
-                if not self._active_connections[session_id]:
+        # A snapshot is taken and sent while holding the send lock. Every event sent before it was published, and
+        # hence applied, before the snapshot was taken, so the client never rolls back to an older state.
+        send_lock = asyncio.Lock()
+        try:
+            async with self._manager.subscribe(*[f"{topic}:{session_id}" for topic in topics]) as subscriber:
+                for topic in topics:
+                    await self._send_snapshot(websocket, session_id, topic, tagged, send_lock)
+                tasks = {
+                    asyncio.create_task(self._forward_events(websocket, session_id, subscriber, tagged, send_lock)),
+                    asyncio.create_task(self._receive_requests(websocket, session_id, topics, tagged, send_lock))
+                }
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in pending:
+                    task.cancel()
+                for task in done:
+                    task.result()
+        except WebSocketDisconnect:
+            #TODO: remove user from session?
+            pass
+        except HTTPException:
+            await websocket.close(code=1001, reason='Session does not exist.')
+        except SlowConsumer:
+            # the client reconnects and starts over with a snapshot
+            await websocket.close(code=1013, reason='Connection too slow.')
+        finally:
+            connections = self._active_connections.get(session_id)
+            if connections is not None:
+                connections.discard(websocket)
+                if not connections:
                     del self._active_connections[session_id]
+                    for topic in TOPICS:
+                        self._legacy_states.pop(f"{topic}:{session_id}", None)
+
+    @staticmethod
+    def frame(topic: str, message: str) -> str:
+        # The message is already serialized JSON, so the frame is put together without parsing it again.
+        return f'{{"topic":"{topic}","event":{message}}}'
+
+    async def _send_snapshot(self, websocket: WebSocket, session_id: str, topic: str, tagged: bool, send_lock: asyncio.Lock) -> None:
+        async with send_lock:
+            if tagged:
+                snapshot = await self._snapshot_provider(session_id, topic)
+                await websocket.send_text(self.frame(topic, snapshot.model_dump_json(by_alias=True)))
+            else:
+                await websocket.send_text(await self._read_state(session_id, topic))
+
+    async def _read_state(self, session_id: str, topic: str) -> str:
+        return (await self._state_provider(session_id, topic)).model_dump_json(by_alias=True)
+
+    # Every untagged connection of a channel receives the same event object, the first one to get it reads the state
+    # and the others wait for that read, so an event costs one read per replica instead of one per connection.
+    async def _send_state(self, websocket: WebSocket, session_id: str, topic: str, event: Event,
+                          send_lock: asyncio.Lock) -> None:
+        channel = f"{topic}:{session_id}"
+        legacy_state = self._legacy_states.get(channel)
+        if legacy_state is None or legacy_state[0] is not event:
+            legacy_state = (event, asyncio.ensure_future(self._read_state(session_id, topic)))
+            self._legacy_states[channel] = legacy_state
+        # shielded, a connection that closes must not cancel the read the others wait for
+        state = await asyncio.shield(legacy_state[1])
+        async with send_lock:
+            await websocket.send_text(state)
+
+    async def _forward_events(self, websocket: WebSocket, session_id: str, subscriber: Subscriber, tagged: bool,
+                              send_lock: asyncio.Lock) -> None:
+        async for event in subscriber:
+            topic = event.channel.split(":", 1)[0]
+            if isinstance(event, Resync):  # events were dropped because the client fell behind
+                await self._send_snapshot(websocket, session_id, topic, tagged, send_lock)
+                continue
+            if tagged:
+                # We technically send a json, but it is in string format. Using "send_json" would
+                # result in redundant serialization as it was done so before publishing to redis.
+                async with send_lock:
+                    await websocket.send_text(self.frame(topic, event.message))
+            else:
+                await self._send_state(websocket, session_id, topic, event, send_lock)
+            if event.published_at is not None:
+                FANOUT_LAG.labels(topic).observe(time.time() - event.published_at)
+
+    async def _receive_requests(self, websocket: WebSocket, session_id: str, topics: list[str], tagged: bool, send_lock: asyncio.Lock) -> None:
+        # Clients that detect a gap in the sequence numbers ask for a fresh snapshot with
+        # {"type": "snapshot", "topic": ...}. Without a topic, all topics of the connection are sent.
+        while True:
+            try:
+                request = json.loads(await websocket.receive_text())
+            except ValueError:
+                continue
+            if not isinstance(request, dict) or request.get("type") != "snapshot":
+                continue
+            for topic in topics:
+                if request.get("topic") in (None, topic):
+                    await self._send_snapshot(websocket, session_id, topic, tagged, send_lock)
+
+    def get_session_ids(self) -> set[str]:
+        return set(self._active_connections)
 
+    def get_statistics(self) -> dict:
+        return {
+            "sessions": len(self._active_connections),
+            "connections": sum(len(connections) for connections in self._active_connections.values())
+        }
 
     async def disconnect(self, session_id: str) -> None:
         if session_id not in self._active_connections:
             return
 
-        for websocket in self._active_connections[session_id]:
+        for websocket in list(self._active_connections.get(session_id, ())):
             try:
                 await websocket.close(code=1001, reason='Session ended.')
-            except WebSocketDisconnect as e:
+            except (WebSocketDisconnect, RuntimeError) as e:
                 print(f"WebSocket for session {session_id} already disconnected: {e}")
-        del self._active_connections[session_id]
\ No newline at end of file
+        self._active_connections.pop(session_id, None)
@@ -1,7 +1,9 @@
 import asyncio
 import os
+import time
 
 from pydantic import BaseModel
+from typing import Optional
 
 from redis.asyncio import Redis
 from ws.event import Event
@@ -9,6 +11,7 @@ from ws.event import Event
 REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_PORT = int(os.getenv("REDIS_PORT"))
 REDIS_SSL = os.getenv("REDIS_SSL", "false") == "true"
+BROADCASTER_QUEUE_SIZE = int(os.getenv("BROADCASTER_QUEUE_SIZE") or 1024)
 
 
 # This WS code is inspired by the encode/broadcaster package.
@@ -18,7 +21,8 @@ class DatabaseBroadcaster:
         self._connection = Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, ssl=REDIS_SSL)
         self._pubsub = self._connection.pubsub()
         self._ready = asyncio.Event()
-        self._queue: asyncio.Queue[Event] = asyncio.Queue()
+        # Bounded: if the manager falls behind, reading from the pubsub connection pauses instead of buffering forever.
+        self._queue: asyncio.Queue[Event] = asyncio.Queue(maxsize=BROADCASTER_QUEUE_SIZE)
         self._listener: asyncio.Task[None] | None = None
 
     async def connect(self) -> None:
@@ -43,7 +47,15 @@ class DatabaseBroadcaster:
 
     async def publish(self, channel: str, message: BaseModel) -> None:
         serialized_message = message.model_dump_json(by_alias=True)
-        await self._connection.publish(channel, serialized_message)
+        await self._connection.publish(channel, f"{time.time():.6f} {serialized_message}")
+
+    @staticmethod
+    def decode(data: str) -> tuple[Optional[float], str]:
+        # Messages start with the time they were published. Replicas that do not send it yet publish bare JSON.
+        if data.startswith("{"):
+            return None, data
+        published_at, _, message = data.partition(" ")
+        return float(published_at), message
 
     async def next_published(self) -> Event:
         return await self._queue.get()
@@ -55,9 +67,11 @@ class DatabaseBroadcaster:
             await self._ready.wait()
             async for message in self._pubsub.listen():
                 if message["type"] == "message":
+                    published_at, data = self.decode(message["data"].decode())
                     event = Event(
                         channel=message["channel"].decode(),
-                        message=message["data"].decode()
+                        message=data,
+                        published_at=published_at
                     )
                     await self._queue.put(event)
             self._ready.clear()
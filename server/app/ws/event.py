@@ -1,10 +1,27 @@
+from typing import Optional
+
+
 class Event:
-    def __init__(self, channel: str, message: str) -> None:
+    def __init__(self, channel: str, message: str, published_at: Optional[float] = None) -> None:
         self.channel = channel
         self.message = message
+        # wall clock time of the publish, to measure the fan-out lag across replicas
+        self.published_at = published_at
 
     def __eq__(self, other: object) -> bool:
         return isinstance(other, Event) and self.channel == other.channel and self.message == other.message
 
     def __repr__(self) -> str:
         return f"Event(channel={self.channel!r}, message={self.message!r})"
+
+
+# Put in place of the events a subscriber fell behind on, it has to fetch the current state of the channel anew.
+class Resync:
+    def __init__(self, channel: str) -> None:
+        self.channel = channel
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, Resync) and self.channel == other.channel
+
+    def __repr__(self) -> str:
+        return f"Resync(channel={self.channel!r})"
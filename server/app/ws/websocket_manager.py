@@ -1,22 +1,31 @@
 from __future__ import annotations
 
 import asyncio
+import os
 
 from contextlib import asynccontextmanager
 from pydantic import BaseModel
 from typing import Any, AsyncGenerator, AsyncIterator
 
 from ws.database_broadcaster import DatabaseBroadcaster
-from ws.event import Event
+from ws.event import Event, Resync
+
+WEBSOCKET_QUEUE_SIZE = int(os.getenv("WEBSOCKET_QUEUE_SIZE") or 64)
+WEBSOCKET_OVERFLOW_POLICY = os.getenv("WEBSOCKET_OVERFLOW_POLICY") or "snapshot"
+OVERFLOW_POLICIES = ("drop_oldest", "snapshot", "disconnect")
 
 
 # This WS code is inspired by the encode/broadcaster package.
 # If something needs to be fixed or changed, look at their GitHub repo.
 class WebsocketManager:
-    def __init__(self) -> None:
+    def __init__(self, queue_size: int = WEBSOCKET_QUEUE_SIZE, overflow_policy: str = WEBSOCKET_OVERFLOW_POLICY) -> None:
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown websocket overflow policy {overflow_policy!r}, expected one of {OVERFLOW_POLICIES}")
         self._broadcaster = DatabaseBroadcaster()
-        self._subscribers: dict[str, set[asyncio.Queue[Event | None]]] = {}
+        self._subscribers: dict[str, set[Subscriber]] = {}
         self._listener_task: asyncio.Task[None] | None = None
+        self._queue_size = queue_size
+        self._overflow_policy = overflow_policy
 
     async def __aenter__(self) -> WebsocketManager:
         await self.connect()
@@ -37,51 +46,111 @@ class WebsocketManager:
         await self._broadcaster.disconnect()
 
     async def _listener(self) -> None:
+        # Delivery never waits for a subscriber, a slow client cannot hold up the events of everyone else.
         while True:
             event = await self._broadcaster.next_published()
-            for queue in list(self._subscribers.get(event.channel, [])):
-                await queue.put(event)
+            for subscriber in list(self._subscribers.get(event.channel, [])):
+                subscriber.deliver(event)
 
     async def publish(self, channel: str, message: BaseModel) -> None:
         await self._broadcaster.publish(channel, message)
 
+    def get_statistics(self) -> dict[str, int]:
+        subscribers = {subscriber for channel_subscribers in self._subscribers.values() for subscriber in channel_subscribers}
+        return {
+            "subscribers": len(subscribers),
+            "max_lag": max((subscriber.lag for subscriber in subscribers), default=0),
+            "dropped_events": sum(subscriber.dropped for subscriber in subscribers)
+        }
+
+    # One queue receives the events of all given channels, the channel of every event tells them apart.
     @asynccontextmanager
-    async def subscribe(self, channel: str) -> AsyncIterator[Subscriber]:
-        queue: asyncio.Queue[Event | None] = asyncio.Queue()
+    async def subscribe(self, *channels: str) -> AsyncIterator[Subscriber]:
+        subscriber = Subscriber(channels, self._queue_size, self._overflow_policy)
+        subscribed = []
 
         try:
-            if not self._subscribers.get(channel):
-                await self._broadcaster.subscribe(channel)
-                self._subscribers[channel] = {queue}
-            else:
-                self._subscribers[channel].add(queue)
-
-            yield Subscriber(queue)
+            for channel in channels:
+                if not self._subscribers.get(channel):
+                    self._subscribers[channel] = {subscriber}
+                    subscribed.append(channel)
+                    await self._broadcaster.subscribe(channel)
+                else:
+                    self._subscribers[channel].add(subscriber)
+                    subscribed.append(channel)
+
+            yield subscriber
         finally:
-            self._subscribers[channel].remove(queue)
-            if not self._subscribers.get(channel):
-                del self._subscribers[channel]
-                await self._broadcaster.unsubscribe(channel)
-            await queue.put(None)
+            for channel in subscribed:
+                self._subscribers[channel].remove(subscriber)
+                if not self._subscribers.get(channel):
+                    del self._subscribers[channel]
+                    await self._broadcaster.unsubscribe(channel)
+            subscriber.close()
 
 
 class Subscriber:
-    def __init__(self, queue: asyncio.Queue[Event | None]) -> None:
-        self._queue = queue
+    def __init__(self, channels: tuple[str, ...], max_size: int, overflow_policy: str) -> None:
+        # The queue itself is unbounded so that the markers below always fit, deliver keeps the events within max_size.
+        self._queue: asyncio.Queue[Event | Resync | SlowConsumer | None] = asyncio.Queue()
+        self._channels = channels
+        self._max_size = max_size
+        self._overflow_policy = overflow_policy
+        self._disconnecting = False
+        self.dropped = 0
+
+    @property
+    def lag(self) -> int:
+        return self._queue.qsize()
+
+    def deliver(self, event: Event) -> None:
+        if self._disconnecting:
+            return
+        if self._queue.qsize() < self._max_size:
+            self._queue.put_nowait(event)
+        elif self._overflow_policy == "drop_oldest":
+            self._queue.get_nowait()
+            self._queue.put_nowait(event)
+            self.dropped += 1
+        elif self._overflow_policy == "snapshot":
+            # everything queued is replaced by one request per channel to send the latest state instead
+            self.dropped += self._drain() + 1
+            for channel in self._channels:
+                self._queue.put_nowait(Resync(channel))
+        else:
+            self.dropped += self._drain() + 1
+            self._queue.put_nowait(SlowConsumer())
+            self._disconnecting = True
+
+    def _drain(self) -> int:
+        drained = 0
+        while not self._queue.empty():
+            if isinstance(self._queue.get_nowait(), Event):
+                drained += 1
+        return drained
 
-    async def __aiter__(self) -> AsyncGenerator[Event | None, None] | None:
+    def close(self) -> None:
+        self._queue.put_nowait(None)
+
+    async def __aiter__(self) -> AsyncGenerator[Event | Resync, None] | None:
         try:
             while True:
                 yield await self.get()
         except Unsubscribed:
             pass
 
-    async def get(self) -> Event:
+    async def get(self) -> Event | Resync:
         item = await self._queue.get()
         if item is None:
             raise Unsubscribed()
+        if isinstance(item, SlowConsumer):
+            raise item
         return item
 
 
 class Unsubscribed(Exception):
     pass
+
+
+class SlowConsumer(Exception):
+    pass
@@ -0,0 +1,216 @@
+"""Simulates parties against the HTTP API and reports latency percentiles and error rates per route.
+
+Every party has a host and guests with guest tokens from /token. The host creates a session from search results,
+the guests join it and then search, add songs and vote with random think times until the run ends. Runs with the
+same arguments issue the same sequence of actions.
+
+Usage: python server/benchmarks/load_test.py [--base-url http://localhost:8000] [--sessions 10] [--guests 20]
+                                             [--duration 60] [--think-time 5] [--seed 42] [--json report.json]
+
+Without --base-url the app is started in-process from controller.py, with the Redis and Postgres configured in the
+environment, e.g. the containers of docker-compose.yml.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+import httpx
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+SEARCH_PATTERNS = ("love", "night", "dance", "the", "baby", "fire", "summer", "heart", "girl", "time", "rock", "blue")
+# relative weights of the actions of a guest
+ACTIONS = {"search": 4, "add_song": 1, "vote": 5}
+
+
+class Statistics:
+    def __init__(self) -> None:
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.statuses: dict[str, dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+    def record(self, route: str, seconds: float, status: str) -> None:
+        self.latencies[route].append(seconds * 1000)
+        self.statuses[route][status] += 1
+
+    @staticmethod
+    def percentile(sorted_values: list[float], percent: float) -> float:
+        # nearest rank
+        index = max(0, min(len(sorted_values) - 1, round(percent / 100 * len(sorted_values) + 0.5) - 1))
+        return sorted_values[index]
+
+    def report(self, elapsed_seconds: float) -> dict:
+        routes = {}
+        for route in sorted(self.latencies):
+            latencies = sorted(self.latencies[route])
+            statuses = dict(self.statuses[route])
+            requests = len(latencies)
+            # 4xx replies are part of normal use, e.g. votes on recommendations that were just replaced
+            errors = sum(count for status, count in statuses.items() if not status.isdigit() or int(status) >= 500)
+            rejected = sum(count for status, count in statuses.items() if status.isdigit() and 400 <= int(status) < 500)
+            routes[route] = {
+                "requests": requests,
+                "requests_per_second": requests / elapsed_seconds,
+                "p50_ms": self.percentile(latencies, 50),
+                "p95_ms": self.percentile(latencies, 95),
+                "p99_ms": self.percentile(latencies, 99),
+                "max_ms": latencies[-1],
+                "error_rate": errors / requests,
+                "rejected_rate": rejected / requests,
+                "statuses": statuses
+            }
+        return {"elapsed_seconds": elapsed_seconds, "routes": routes}
+
+
+class Party:
+    def __init__(self, client: httpx.AsyncClient, statistics: Statistics, rng: random.Random, number: int,
+                 guest_count: int, think_time: float, deadline: float) -> None:
+        self.client = client
+        self.statistics = statistics
+        self.rng = rng
+        self.number = number
+        self.guest_count = guest_count
+        self.think_time = think_time
+        self.deadline = deadline
+        self.session_id = ""
+
+    async def request(self, route: str, method: str, url: str, token: str = "", **kwargs) -> httpx.Response | None:
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, headers=headers, **kwargs)
+        except httpx.HTTPError as e:
+            self.statistics.record(route, time.perf_counter() - start, type(e).__name__)
+            return None
+        self.statistics.record(route, time.perf_counter() - start, str(response.status_code))
+        return response
+
+    async def create_user(self, username: str) -> str:
+        response = await self.request("POST /token", "POST", "/token", json={"username": username})
+        if response is None or response.is_error:
+            return ""
+        return response.json()["accessToken"]
+
+    async def search(self, token: str, rng: random.Random) -> list[dict]:
+        response = await self.request("GET /songs", "GET", "/songs", token,
+                                      params={"pattern": rng.choice(SEARCH_PATTERNS), "limit": 10})
+        if response is None or response.is_error:
+            return []
+        return response.json()["songs"]
+
+    async def think(self, rng: random.Random) -> bool:
+        # False once the run is over
+        await asyncio.sleep(min(rng.expovariate(1 / self.think_time), max(0.0, self.deadline - time.monotonic())))
+        return time.monotonic() < self.deadline
+
+    async def guest(self, number: int, seed: float) -> None:
+        # every guest has its own random generator, so its actions do not depend on the scheduling of the others
+        rng = random.Random(seed)
+        token = await self.create_user(f"guest-{self.number}-{number}")
+        if not token:
+            return
+        response = await self.request("PATCH /sessions/{session_id}/guests", "PATCH",
+                                      f"/sessions/{self.session_id}/guests", token)
+        if response is None or response.is_error:
+            return
+        found: list[dict] = []
+        while await self.think(rng):
+            action = rng.choices(list(ACTIONS), weights=list(ACTIONS.values()))[0]
+            if action == "search" or (action == "add_song" and not found):
+                found = await self.search(token, rng) or found
+            elif action == "add_song":
+                await self.request("PATCH /sessions/{session_id}/songs", "PATCH", f"/sessions/{self.session_id}/songs",
+                                   token, params={"song_id": rng.choice(found)["id"]})
+            else:
+                response = await self.request("GET /sessions/{session_id}/recommendations", "GET",
+                                              f"/sessions/{self.session_id}/recommendations", token)
+                recommendations = response.json()["songs"] if response is not None and not response.is_error else []
+                if recommendations:
+                    song_id = rng.choice(recommendations)["id"]
+                    await self.request("PATCH /sessions/{session_id}/recommendations/{song_id}/vote", "PATCH",
+                                       f"/sessions/{self.session_id}/recommendations/{song_id}/vote", token)
+
+    async def run(self) -> None:
+        host_token = await self.create_user(f"host-{self.number}")
+        songs = await self.search(host_token, self.rng) if host_token else []
+        if not songs:
+            return
+        session = {"name": f"Party {self.number}", "playlist": {"queuedSongs": self.rng.sample(songs, min(2, len(songs)))}}
+        response = await self.request("POST /sessions", "POST", "/sessions", host_token, json=session)
+        if response is None or response.is_error:
+            return
+        self.session_id = response.json()["id"]
+        seeds = [self.rng.random() for _ in range(self.guest_count)]
+        await asyncio.gather(*(self.guest(number, seed) for number, seed in enumerate(seeds)))
+        await self.request("DELETE /sessions/{session_id}", "DELETE", f"/sessions/{self.session_id}", host_token)
+
+
+@asynccontextmanager
+async def in_process_client(timeout: float):
+    sys.path.insert(0, APP_DIR)
+    from controller import app  # noqa: E402
+
+    # the transport does not run the lifespan of the app, connections and background tasks are started here
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://load-test",
+                                     timeout=timeout) as client:
+            yield client
+
+
+@asynccontextmanager
+async def remote_client(base_url: str, timeout: float, connections: int):
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        yield client
+
+
+async def run(args: argparse.Namespace) -> dict:
+    statistics = Statistics()
+    rng = random.Random(args.seed)
+    connections = args.sessions * (args.guests + 1)
+    client_context = (remote_client(args.base_url, args.timeout, connections) if args.base_url
+                      else in_process_client(args.timeout))
+    async with client_context as client:
+        start = time.monotonic()
+        deadline = start + args.duration
+        parties = [
+            Party(client, statistics, random.Random(rng.random()), number, args.guests, args.think_time, deadline)
+            for number in range(args.sessions)
+        ]
+        await asyncio.gather(*(party.run() for party in parties))
+        return statistics.report(time.monotonic() - start)
+
+
+def print_report(report: dict) -> None:
+    print(f"{'route':<58} {'requests':>8} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7} {'4xx':>7}")
+    for route, result in report["routes"].items():
+        print(f"{route:<58} {result['requests']:>8} {result['requests_per_second']:>7.1f} {result['p50_ms']:>8.1f} "
+              f"{result['p95_ms']:>8.1f} {result['p99_ms']:>8.1f} {result['error_rate']:>7.1%} {result['rejected_rate']:>7.1%}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--base-url", help="URL of a running server, the app is started in-process if omitted")
+    parser.add_argument("--sessions", type=int, default=10, help="parties running at the same time")
+    parser.add_argument("--guests", type=int, default=20, help="guests per party")
+    parser.add_argument("--duration", type=float, default=60, help="seconds the guests keep acting")
+    parser.add_argument("--think-time", type=float, default=5, help="mean seconds between two actions of a guest")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds until a request counts as failed")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
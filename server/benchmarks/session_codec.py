@@ -0,0 +1,108 @@
+"""Compares the session codecs by stored bytes and encode/decode time per session size.
+
+Usage: python server/benchmarks/session_codec.py [--sizes 10 100 1000] [--guests 50] [--repeat 20]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from models.session import Session  # noqa: E402
+from models.song import Song, Playlist  # noqa: E402
+from models.user import User  # noqa: E402
+from session_codec import SongDecoder, get_session_codec  # noqa: E402
+
+
+def make_session(song_count: int, guest_count: int, rng: random.Random) -> Session:
+    guests = {f"guest-{i}": User(id=f"guest-{i}", username=f"Guest {i}") for i in range(guest_count)}
+    users = list(guests.values())
+    songs = []
+    for i in range(song_count):
+        songs.append(Song(
+            id=f"{i:022d}",
+            track_name=f"Track {i}",
+            album=f"Album {i % 40}",
+            artists=[f"Artist {i % 25}", f"Artist {i % 7}"],
+            artist_ids=[f"{i % 25:022d}", f"{i % 7:022d}"],
+            danceability=rng.random(),
+            energy=rng.random(),
+            speechiness=rng.random(),
+            valence=rng.random(),
+            tempo=rng.uniform(60, 200),
+            duration_ms=rng.randint(120000, 300000),
+            release_date=datetime(2000 + i % 24, 1, 1),
+            genre=["pop"],
+            added_by=rng.choice(users) if i % 2 else None,
+            most_significant_feature="energy",
+            similarity_score=rng.random(),
+            votes=rng.sample(list(guests), k=min(3, guest_count))
+        ))
+    current = song_count // 2
+    return Session(
+        id="benchmark",
+        name="Benchmark",
+        guests=guests,
+        playlist=Playlist(played_songs=songs[:current], current_song=songs[current], queued_songs=songs[current + 1:])
+    )
+
+
+def measure(function, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def benchmark_document(session: Session, repeat: int) -> tuple[int, float, float]:
+    # the whole session as one JSON document, as sessions were stored before the granular structures
+    document = session.model_dump_json()
+    encode_ms = measure(session.model_dump_json, repeat)
+    decode_ms = measure(lambda: Session.model_validate_json(document), repeat)
+    return len(document.encode()), encode_ms, decode_ms
+
+
+def benchmark_codec(name: str, session: Session, repeat: int) -> tuple[int, float, float]:
+    codec = get_session_codec(name)
+    songs = session.playlist.get_all_songs()
+    encoded = codec.encode_songs(songs)
+    stored = encoded.elements + list(encoded.metadata.values()) + list(encoded.users.values())
+
+    # the triples that the Lua scripts return for the stored songs
+    reply = []
+    for element, song in zip(encoded.elements, songs):
+        user_id = song.added_by.id if song.added_by else None
+        reply.append((element, encoded.metadata.get(song.id, ''), encoded.users.get(user_id, '') if user_id else ''))
+
+    def decode():
+        decoder = SongDecoder()
+        return [decoder.decode_song(*songs_with_references) for songs_with_references in reply]
+
+    encode_ms = measure(lambda: codec.encode_songs(songs), repeat)
+    decode_ms = measure(decode, repeat)
+    return sum(len(value.encode()) for value in stored), encode_ms, decode_ms
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000], help="songs per session")
+    parser.add_argument("--guests", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    print(f"{'songs':>6} {'format':>9} {'bytes':>10} {'encode ms':>10} {'decode ms':>10}")
+    for size in args.sizes:
+        session = make_session(size, args.guests, rng)
+        results = [("document", benchmark_document(session, args.repeat))]
+        results += [(name, benchmark_codec(name, session, args.repeat)) for name in ("json", "compact")]
+        for name, (size_bytes, encode_ms, decode_ms) in results:
+            print(f"{size:>6} {name:>9} {size_bytes:>10} {encode_ms:>10.3f} {decode_ms:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Runs the login and refresh flow of the Spotify client against a local stand-in of the accounts service and Web API.
+
+Usage: python -m pytest server/tests
+"""
+import asyncio
+import base64
+import os
+import sys
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from fastapi import HTTPException  # noqa: E402
+
+from spotify_client import SpotifyClient  # noqa: E402
+
+ACCOUNTS_URL = "http://spotify.test/accounts"
+API_URL = "http://spotify.test/v1"
+CREDENTIALS = "Basic " + base64.b64encode(b"client-id:client-secret").decode()
+
+
+class StandInSpotify:
+    def __init__(self, display_name: str = "Host") -> None:
+        self.display_name = display_name
+        self.access_tokens = set()
+        self.issued = 0
+
+    def issue(self, refresh_token: str = None) -> dict:
+        self.issued += 1
+        access_token = f"access-{self.issued}"
+        self.access_tokens.add(access_token)
+        token = {"access_token": access_token, "token_type": "Bearer", "expires_in": 3600, "scope": "streaming"}
+        if refresh_token:
+            token["refresh_token"] = refresh_token
+        return token
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/accounts/api/token":
+            if request.headers.get("Authorization") != CREDENTIALS:
+                return httpx.Response(401, json={"error": "invalid_client"})
+            form = dict(httpx.QueryParams(request.content.decode()))
+            if form.get("grant_type") == "authorization_code" and form.get("code") == "valid-code" \
+                    and form.get("redirect_uri") == "http://localhost/callback":
+                return httpx.Response(200, json=self.issue(refresh_token="refresh-1"))
+            if form.get("grant_type") == "refresh_token" and form.get("refresh_token") == "refresh-1":
+                return httpx.Response(200, json=self.issue())  # the refresh token is not rotated
+            return httpx.Response(400, json={"error": "invalid_grant"})
+        if request.url.path == "/v1/me":
+            if request.headers.get("Authorization", "").removeprefix("Bearer ") not in self.access_tokens:
+                return httpx.Response(401, json={"error": {"status": 401}})
+            return httpx.Response(200, json={"id": "spotify-user", "display_name": self.display_name})
+        return httpx.Response(404)
+
+
+def make_client(handler) -> SpotifyClient:
+    return SpotifyClient("client-id", "client-secret", "http://localhost/callback", accounts_url=ACCOUNTS_URL,
+                         api_url=API_URL, transport=httpx.MockTransport(handler))
+
+
+def test_login_and_refresh():
+    spotify = StandInSpotify()
+
+    async def run():
+        client = make_client(spotify.handle)
+        try:
+            token = await client.get_access_token("valid-code")
+            assert token.refresh_token == "refresh-1"
+            assert await client.get_display_name(token) == "Host"
+
+            refreshed = await client.refresh_access_token(token.refresh_token)
+            assert refreshed.access_token != token.access_token
+            assert refreshed.refresh_token == "refresh-1"
+            assert await client.get_display_name(refreshed) == "Host"
+        finally:
+            await client.close()
+
+    asyncio.run(run())
+
+
+def test_display_name_falls_back_to_user_id():
+    spotify = StandInSpotify(display_name=None)
+
+    async def run():
+        client = make_client(spotify.handle)
+        try:
+            assert await client.get_display_name(await client.get_access_token("valid-code")) == "spotify-user"
+        finally:
+            await client.close()
+
+    asyncio.run(run())
+
+
+def test_invalid_code_and_unreachable_spotify():
+    def unreachable(request: httpx.Request) -> httpx.Response:
+        raise httpx.ConnectError("stand-in is down", request=request)
+
+    async def run():
+        for handler, status_code in ((StandInSpotify().handle, 401), (unreachable, 502)):
+            client = make_client(handler)
+            try:
+                with pytest.raises(HTTPException) as error:
+                    await client.get_access_token("invalid-code")
+                assert error.value.status_code == status_code
+            finally:
+                await client.close()
+
+    asyncio.run(run())